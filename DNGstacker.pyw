@@ -1,46 +1,24 @@
 import tkinter as tk
 from tkinter import filedialog, ttk
 import numpy as np
-import rawpy
-from PIL import Image, ImageTk, ExifTags
+from PIL import Image, ImageTk
 import threading
 import subprocess
 import os
-import queue
-import psutil
 import sys
-from fractions import Fraction
+from metrics import StackMetrics, format_metrics
+from raw_decode import DECODE_PROFILES, DEFAULT_PROFILE
+from stacking import stack
 
 # Get the script directory and the path to exiftool
 script_directory = os.path.dirname(os.path.abspath(sys.argv[0]))
 exiftool_path = os.path.join(script_directory, "exiftool.exe")
 
-# Queue for inter-thread communication
-result_queue = queue.Queue()
-
-def get_exposure_time(file_path):
-    """Get the exposure time from EXIF data as a Fraction."""
-    with Image.open(file_path) as image:
-        img_exif = image.getexif()
-        for (k, v) in img_exif.items():
-            if ExifTags.TAGS.get(k) == 'ExposureTime':
-                exposure_time = v
-                if isinstance(exposure_time, tuple) and len(exposure_time) == 2:
-                    # Exposure time is a fraction
-                    return Fraction(exposure_time[0], exposure_time[1])
-                else:
-                    # Exposure time is a float
-                    return Fraction(exposure_time)
-    return Fraction(0)
-
-def process_image(file_path, index, total_files):
-    """Process a single image file and put the result in the queue."""
-    with rawpy.imread(file_path) as raw:
-        img = raw.postprocess().astype(np.float32)
-    result_queue.put((index, img))
-    progress_var.set(index + 1)
-    status_var.set(f"Processed image {index + 1}/{total_files}")
-    app.update_idletasks()  # Update the UI
+# Registration modes offered in the UI
+REGISTRATION_CHOICES = {"Off": None, "Translation": "translation", "Homography": "homography"}
+
+# Files from the last selection, for a full stack after a quick look
+selected_files = ()
 
 def update_preview_image(average_image_array):
     """Update the preview image in the UI."""
@@ -50,164 +28,203 @@ def update_preview_image(average_image_array):
     preview_image_label.config(image=img_tk)
     preview_image_label.image = img_tk
 
-def process_images_thread(file_paths):
-    """Process the selected images into the queue."""
-    total_files = len(file_paths)
-    for index, file_path in enumerate(file_paths):
-        process_image(file_path, index, total_files)
-
-def average_images_thread(file_paths, save_path, stacking_method, total_exposure_time):
-    """Perform stacking of images based on the selected method."""
-    total_files = len(file_paths)
-    average_image = None
-    processed_count = 0
-    images_list = []
-
-    while processed_count < total_files:
-        try:
-            index, img = result_queue.get(timeout=0.1)
-            processed_count += 1
-
-            if stacking_method == 'Mean':
-                if average_image is None:
-                    average_image = img
-                else:
-                    average_image = (average_image * (processed_count - 1) + img) / processed_count
-
-            elif stacking_method == 'Maximum':
-                if average_image is None:
-                    average_image = img
-                else:
-                    average_image = np.maximum(average_image, img)
-
-            elif stacking_method == 'Minimum':
-                if average_image is None:
-                    average_image = img
-                else:
-                    average_image = np.minimum(average_image, img)
-
-            elif stacking_method == 'Sigma Clipping':
-                images_list.append(img)
-
-            if processed_count % 100 == 0 or processed_count == total_files:
-                if stacking_method != 'Sigma Clipping':
-                    update_preview_image(average_image)
-
-            cpu_percent = psutil.cpu_percent()
-            memory_percent = psutil.virtual_memory().percent
-            details_var.set(f"Threads: {os.cpu_count()}\nCPU utilization: {cpu_percent}%\nMemory utilization: {memory_percent}%")
-
-        except queue.Empty:
-            pass
-
-    if stacking_method == 'Sigma Clipping':
-        # Stack images into a numpy array
-        stack = np.stack(images_list, axis=0)
-        # Compute mean and standard deviation along the stack axis
-        mean = np.mean(stack, axis=0)
-        std = np.std(stack, axis=0)
-        # Sigma clipping threshold
-        sigma = 2  # You can adjust the sigma value as needed
-        # Create a mask of values within the sigma threshold
-        mask = np.abs(stack - mean) <= sigma * std
-        # Replace outliers with NaN
-        clipped_stack = np.where(mask, stack, np.nan)
-        # Compute mean ignoring NaN values
-        average_image = np.nanmean(clipped_stack, axis=0)
-        # Replace NaN values with zeros
-        average_image = np.nan_to_num(average_image)
-        update_preview_image(average_image)
-
-    # Save the stacked image with EXIF data
-    average_image = np.clip(average_image, 0, 255).astype(np.uint8)
-    img = Image.fromarray(average_image)
-    img_exif = img.getexif()
-    # Set total exposure time in EXIF data
-    img_exif[33434] = (total_exposure_time.numerator, total_exposure_time.denominator)
-    img.save(save_path, exif=img_exif)
-
-    status_var.set("Finished!")
-    app.bell()
+def update_progress(done, total, message):
+    """Show stacking progress in the UI."""
+    # A resumed checkpoint counts the frames it already holds in the total
+    progress_bar.config(maximum=total)
+    progress_var.set(done)
+    status_var.set(message)
+    app.update_idletasks()  # Update the UI
 
-def process_images():
-    """Process the selected images."""
-    file_paths = filedialog.askopenfilenames(title="Select .dng files", filetypes=[("DNG files", "*.dng")])
-    if not file_paths:
-        status_var.set("No files selected.")
+def update_metrics(snapshot):
+    """Show the sampled stage timings, throughput and memory use in the UI."""
+    details_var.set(format_metrics(snapshot))
+
+def stack_images_thread(file_paths, stacking_method, memory_limit, workers, quick_look, bayer, bit_depth, memory_mapped, checkpoint, register, profile):
+    """Stack the selected images off the UI thread."""
+    try:
+        stack(file_paths, stacking_method, workers=workers, memory_limit=memory_limit,
+              progress=update_progress, preview=update_preview_image,
+              quick_look=quick_look, bayer=bayer, bit_depth=bit_depth,
+              memory_mapped=memory_mapped, checkpoint=checkpoint, save=not quick_look,
+              metrics=StackMetrics(callback=update_metrics), register=register, profile=profile)
+    except Exception as e:
+        status_var.set(f"Failed: {e}")
         return
+    if quick_look:
+        status_var.set("Quick look finished. Use Full stack to stack at full quality.")
+        full_stack_button.config(state=tk.NORMAL)
+    app.bell()
 
-    total_exposure_time = Fraction(0)
-    for file_path in file_paths:
-        total_exposure_time += get_exposure_time(file_path)
-
+def start_stack(file_paths, quick_look=False):
+    """Start stacking the given images with the options set in the UI."""
     stacking_method = stacking_method_var.get()
-    save_dir = os.path.dirname(file_paths[0])
-    first_file_name = os.path.splitext(os.path.basename(file_paths[0]))[0]
-    total_exposure_time_float = float(total_exposure_time)
-    save_filename = f"{first_file_name}_{stacking_method}_{total_exposure_time_float:.2f}s.tiff"
-    save_path = os.path.join(save_dir, save_filename)
+    memory_limit = memory_limit_var.get() * 1024 ** 2
+    workers = workers_var.get()
+    # Quick looks always use the fast RGB previews
+    bayer = bayer_var.get() and not quick_look
+    bit_depth = int(bit_depth_var.get().split()[0])
+    memory_mapped = memmap_var.get()
+    # Quick looks are throwaway, so they never touch the checkpoint
+    checkpoint = None if quick_look else checkpoint_var.get() or None
+    register = REGISTRATION_CHOICES[register_var.get()]
+    profile = profile_var.get()
 
     status_var.set("Starting to process images...")
     progress_var.set(0)
     progress_bar.config(maximum=len(file_paths))
 
-    threads = [
-        threading.Thread(target=process_images_thread, args=(file_paths,)),
-        threading.Thread(target=average_images_thread, args=(file_paths, save_path, stacking_method, total_exposure_time)),
-    ]
-
-    for t in threads:
-        t.start()
-
-app = tk.Tk()
-app.title("DNG Averager")
-app.configure(bg='#f0f0f0')
-
-frame = ttk.Frame(app, padding="20 20 20 20")
-frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
-
-title_font = ('Arial', 14, 'bold')
-label_font = ('Arial', 12)
-
-title_label = ttk.Label(frame, text="DNG Averager", font=title_font)
-title_label.grid(row=0, column=0, columnspan=2, sticky=tk.W, pady=(0, 20))
+    threading.Thread(target=stack_images_thread, args=(file_paths, stacking_method, memory_limit, workers, quick_look, bayer, bit_depth, memory_mapped, checkpoint, register, profile)).start()
 
-files_label = ttk.Label(frame, text="Select DNG files to average:", font=label_font)
-files_label.grid(row=1, column=0, sticky=tk.W, padx=(10, 0))
-select_files_button = ttk.Button(frame, text="Select files", command=process_images)
-select_files_button.grid(row=1, column=1, sticky=tk.E, padx=(0, 10))
-
-# Add a label for stacking method
-stacking_label = ttk.Label(frame, text="Select stacking method:", font=label_font)
-stacking_label.grid(row=2, column=0, sticky=tk.W, padx=(10, 0))
-
-stacking_method_var = tk.StringVar(value="Mean")
-
-mean_radio = ttk.Radiobutton(frame, text='Mean', variable=stacking_method_var, value='Mean')
-mean_radio.grid(row=2, column=1, sticky=tk.W)
-
-max_radio = ttk.Radiobutton(frame, text='Maximum', variable=stacking_method_var, value='Maximum')
-max_radio.grid(row=3, column=1, sticky=tk.W)
-
-min_radio = ttk.Radiobutton(frame, text='Minimum', variable=stacking_method_var, value='Minimum')
-min_radio.grid(row=4, column=1, sticky=tk.W)
-
-sigma_clip_radio = ttk.Radiobutton(frame, text='Sigma Clipping', variable=stacking_method_var, value='Sigma Clipping')
-sigma_clip_radio.grid(row=5, column=1, sticky=tk.W)
-
-status_var = tk.StringVar()
-status_label = ttk.Label(frame, textvariable=status_var, font=label_font)
-status_label.grid(row=6, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 0), pady=(20, 0))
-
-progress_var = tk.IntVar()
-progress_bar = ttk.Progressbar(frame, variable=progress_var, mode='determinate')
-progress_bar.grid(row=7, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 10), pady=(10, 0))
-
-details_var = tk.StringVar()
-details_label = ttk.Label(frame, textvariable=details_var, font=label_font, wraplength=400, justify=tk.LEFT)
-details_label.grid(row=8, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 0), pady=(20, 0))
-
-preview_image_label = ttk.Label(frame)
-preview_image_label.grid(row=9, column=0, columnspan=2, padx=(10, 10), pady=(20, 0))
+def select_files():
+    """Ask for DNG files, remembering them for a later full-quality stack."""
+    global selected_files
+    file_paths = filedialog.askopenfilenames(title="Select .dng files", filetypes=[("DNG files", "*.dng")])
+    if not file_paths:
+        status_var.set("No files selected.")
+        return None
+    selected_files = file_paths
+    return file_paths
 
-app.mainloop()
+def process_images():
+    """Process the selected images."""
+    file_paths = select_files()
+    if file_paths:
+        full_stack_button.config(state=tk.DISABLED)
+        start_stack(file_paths)
+
+def quick_look_images():
+    """Quickly stack small previews of the selected images without saving."""
+    file_paths = select_files()
+    if file_paths:
+        full_stack_button.config(state=tk.DISABLED)
+        start_stack(file_paths, quick_look=True)
+
+def choose_checkpoint_folder():
+    """Pick the folder a stack is checkpointed in, so it can be resumed or extended later."""
+    folder = filedialog.askdirectory(title="Select checkpoint folder")
+    if folder:
+        checkpoint_var.set(folder)
+
+def full_stack_images():
+    """Stack the images from the last quick look at full quality."""
+    full_stack_button.config(state=tk.DISABLED)
+    start_stack(selected_files)
+
+# Decode workers re-import this script, so only build the UI when run directly
+if __name__ == "__main__":
+    app = tk.Tk()
+    app.title("DNG Averager")
+    app.configure(bg='#f0f0f0')
+
+    frame = ttk.Frame(app, padding="20 20 20 20")
+    frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+
+    title_font = ('Arial', 14, 'bold')
+    label_font = ('Arial', 12)
+
+    title_label = ttk.Label(frame, text="DNG Averager", font=title_font)
+    title_label.grid(row=0, column=0, columnspan=2, sticky=tk.W, pady=(0, 20))
+
+    files_label = ttk.Label(frame, text="Select DNG files to average:", font=label_font)
+    files_label.grid(row=1, column=0, sticky=tk.W, padx=(10, 0))
+    buttons_frame = ttk.Frame(frame)
+    buttons_frame.grid(row=1, column=1, sticky=tk.E, padx=(0, 10))
+    select_files_button = ttk.Button(buttons_frame, text="Select files", command=process_images)
+    select_files_button.grid(row=0, column=0)
+    # Quick look stacks small previews first so a bad sequence can be rejected in seconds
+    quick_look_button = ttk.Button(buttons_frame, text="Quick look", command=quick_look_images)
+    quick_look_button.grid(row=0, column=1, padx=(5, 0))
+    full_stack_button = ttk.Button(buttons_frame, text="Full stack", command=full_stack_images, state=tk.DISABLED)
+    full_stack_button.grid(row=0, column=2, padx=(5, 0))
+
+    # Add a label for stacking method
+    stacking_label = ttk.Label(frame, text="Select stacking method:", font=label_font)
+    stacking_label.grid(row=2, column=0, sticky=tk.W, padx=(10, 0))
+
+    stacking_method_var = tk.StringVar(value="Mean")
+
+    mean_radio = ttk.Radiobutton(frame, text='Mean', variable=stacking_method_var, value='Mean')
+    mean_radio.grid(row=2, column=1, sticky=tk.W)
+
+    max_radio = ttk.Radiobutton(frame, text='Maximum', variable=stacking_method_var, value='Maximum')
+    max_radio.grid(row=3, column=1, sticky=tk.W)
+
+    min_radio = ttk.Radiobutton(frame, text='Minimum', variable=stacking_method_var, value='Minimum')
+    min_radio.grid(row=4, column=1, sticky=tk.W)
+
+    sigma_clip_radio = ttk.Radiobutton(frame, text='Sigma Clipping', variable=stacking_method_var, value='Sigma Clipping')
+    sigma_clip_radio.grid(row=5, column=1, sticky=tk.W)
+
+    # Memory ceiling for sigma clipping, in megabytes
+    memory_limit_label = ttk.Label(frame, text="Sigma clipping memory limit (MB):", font=label_font)
+    memory_limit_label.grid(row=6, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    memory_limit_var = tk.IntVar(value=2048)
+    memory_limit_spinbox = ttk.Spinbox(frame, from_=256, to=65536, increment=256, textvariable=memory_limit_var, width=8)
+    memory_limit_spinbox.grid(row=6, column=1, sticky=tk.W, pady=(10, 0))
+
+    # Number of processes decoding RAW files in parallel
+    workers_label = ttk.Label(frame, text="Decode workers:", font=label_font)
+    workers_label.grid(row=7, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    workers_var = tk.IntVar(value=os.cpu_count() or 1)
+    workers_spinbox = ttk.Spinbox(frame, from_=1, to=256, textvariable=workers_var, width=8)
+    workers_spinbox.grid(row=7, column=1, sticky=tk.W, pady=(10, 0))
+
+    # Stack the undemosaiced sensor data and demosaic once at the end
+    bayer_var = tk.BooleanVar(value=False)
+    bayer_check = ttk.Checkbutton(frame, text="Stack raw Bayer data (demosaic once)", variable=bayer_var)
+    bayer_check.grid(row=8, column=0, columnspan=2, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+
+    # Bit depth of the saved TIFF; 16 and 32-bit keep the precision the stack accumulated
+    bit_depth_label = ttk.Label(frame, text="Output bit depth:", font=label_font)
+    bit_depth_label.grid(row=9, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    bit_depth_var = tk.StringVar(value="8")
+    bit_depth_combo = ttk.Combobox(frame, textvariable=bit_depth_var, values=["8", "16", "32 (float)"], state="readonly", width=10)
+    bit_depth_combo.grid(row=9, column=1, sticky=tk.W, pady=(10, 0))
+
+    # Keep the running stack in a temporary file instead of RAM
+    memmap_var = tk.BooleanVar(value=False)
+    memmap_check = ttk.Checkbutton(frame, text="Memory-map the running stack", variable=memmap_var)
+    memmap_check.grid(row=10, column=0, columnspan=2, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+
+    # Checkpoint folder; stacking again with the same folder resumes or adds to that stack
+    checkpoint_label = ttk.Label(frame, text="Checkpoint folder (optional):", font=label_font)
+    checkpoint_label.grid(row=11, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    checkpoint_frame = ttk.Frame(frame)
+    checkpoint_frame.grid(row=11, column=1, sticky=tk.W, pady=(10, 0))
+    checkpoint_var = tk.StringVar(value="")
+    checkpoint_entry = ttk.Entry(checkpoint_frame, textvariable=checkpoint_var, width=24)
+    checkpoint_entry.grid(row=0, column=0)
+    checkpoint_button = ttk.Button(checkpoint_frame, text="Browse", command=choose_checkpoint_folder)
+    checkpoint_button.grid(row=0, column=1, padx=(5, 0))
+
+    # Align each frame to the first before stacking, for handheld or drifting sequences
+    register_label = ttk.Label(frame, text="Frame registration:", font=label_font)
+    register_label.grid(row=12, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    register_var = tk.StringVar(value="Off")
+    register_combo = ttk.Combobox(frame, textvariable=register_var, values=list(REGISTRATION_CHOICES), state="readonly", width=12)
+    register_combo.grid(row=12, column=1, sticky=tk.W, pady=(10, 0))
+
+    # LibRaw decode profile; 'full' develops 16-bit frames for the stack
+    profile_label = ttk.Label(frame, text="Decode profile:", font=label_font)
+    profile_label.grid(row=13, column=0, sticky=tk.W, padx=(10, 0), pady=(10, 0))
+    profile_var = tk.StringVar(value=DEFAULT_PROFILE)
+    profile_combo = ttk.Combobox(frame, textvariable=profile_var, values=list(DECODE_PROFILES), state="readonly", width=12)
+    profile_combo.grid(row=13, column=1, sticky=tk.W, pady=(10, 0))
+
+    status_var = tk.StringVar()
+    status_label = ttk.Label(frame, textvariable=status_var, font=label_font)
+    status_label.grid(row=14, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 0), pady=(20, 0))
+
+    progress_var = tk.IntVar()
+    progress_bar = ttk.Progressbar(frame, variable=progress_var, mode='determinate')
+    progress_bar.grid(row=15, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 10), pady=(10, 0))
+
+    details_var = tk.StringVar()
+    details_label = ttk.Label(frame, textvariable=details_var, font=label_font, wraplength=400, justify=tk.LEFT)
+    details_label.grid(row=16, column=0, columnspan=2, sticky=(tk.W, tk.E), padx=(10, 0), pady=(20, 0))
+
+    preview_image_label = ttk.Label(frame)
+    preview_image_label.grid(row=17, column=0, columnspan=2, padx=(10, 10), pady=(20, 0))
+
+    app.mainloop()
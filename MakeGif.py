@@ -1,16 +1,42 @@
 import sys
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                              QPushButton, QLabel, QFileDialog, QListWidget, QFrame,
                              QListWidgetItem, QProgressBar, QMessageBox, QComboBox,
                              QSlider, QCheckBox, QSizePolicy, QGridLayout, QScrollArea,
                              QSpinBox, QTabWidget)
-from PyQt6.QtGui import QPixmap, QIcon, QColor, QPalette, QFont, QDrag
-from PyQt6.QtCore import Qt, QSize, QTimer, QPropertyAnimation, QEasingCurve, QMimeData, QPoint
-from PIL import Image
-import imageio
+from PyQt6.QtGui import QPixmap, QIcon, QColor, QPalette, QFont, QDrag, QImage
+from PyQt6.QtCore import (Qt, QSize, QTimer, QPropertyAnimation, QEasingCurve, QMimeData, QPoint,
+                          QObject, QRect, pyqtSignal)
 import numpy as np
-import rawpy
+from animation import export_animation
+from frame_cache import FrameCache
+from thumbnails import ThumbnailCache, load_scaled
+
+# Threads decoding thumbnails; Pillow and LibRaw release the GIL while they decode
+THUMBNAIL_WORKERS = min(4, os.cpu_count() or 1)
+
+# Thumbnails kept ready to draw in memory, about 40 KB each
+THUMBNAIL_MEMORY_ITEMS = 2000
+
+# Memory for preview frames decoded ahead of the playhead
+PREVIEW_CACHE_BYTES = 1024 ** 3
+
+# Threads decoding preview frames
+PREVIEW_WORKERS = 2
+
+# Preview frames are scaled to the widget size rounded up to this, so small
+# resizes don't throw the cache away
+PREVIEW_SIZE_STEP = 256
+
+def to_qimage(array):
+    """Copy an RGB uint8 array into a QImage, which unlike a QPixmap can be made off the GUI thread."""
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    return QImage(array.data, width, height, array.strides[0], QImage.Format.Format_RGB888).copy()
 
 class ImagePreviewWidget(QLabel):
     def __init__(self, parent=None):
@@ -19,16 +45,38 @@ class ImagePreviewWidget(QLabel):
         self.setStyleSheet("background-color: #2a2a2a; border: 1px solid #444444; border-radius: 4px;")
         self.setMinimumSize(400, 400)
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.source = None
+        self.zoom = 1.0
 
     def set_image(self, pixmap):
         if pixmap:
-            scaled_pixmap = pixmap.scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-            self.setPixmap(scaled_pixmap)
+            self.source = pixmap
+            self.update_pixmap()
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.update_pixmap()
+
+    def update_pixmap(self):
+        """Fit the image to the widget at the zoom level, showing the middle of it when zoomed in."""
+        if self.source is None:
+            return
+        scaled_pixmap = self.source.scaled(self.size() * self.zoom, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        if self.zoom > 1:
+            width = min(scaled_pixmap.width(), self.width())
+            height = min(scaled_pixmap.height(), self.height())
+            scaled_pixmap = scaled_pixmap.copy(QRect((scaled_pixmap.width() - width) // 2,
+                                                     (scaled_pixmap.height() - height) // 2, width, height))
+        self.setPixmap(scaled_pixmap)
+
+    def clear(self):
+        self.source = None
+        super().clear()
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
-        if self.pixmap():
-            self.set_image(self.pixmap().copy())
+        # Rescale from the source rather than the last scaled pixmap, which would lose detail each time
+        self.update_pixmap()
 
 class CustomListWidget(QListWidget):
     def __init__(self, parent=None):
@@ -117,7 +165,7 @@ class ToggleButton(AnimatedButton):
             """)
 
 class ThumbnailWidget(QWidget):
-    def __init__(self, image_path, parent=None):
+    def __init__(self, image_path, pixmap=None, parent=None):
         super().__init__(parent)
         self.image_path = image_path
         self.layout = QVBoxLayout(self)
@@ -127,12 +175,195 @@ class ThumbnailWidget(QWidget):
         self.layout.addWidget(self.image_label)
         self.layout.addWidget(self.text_label)
         self.setFixedSize(120, 120)
-        self.load_thumbnail()
+        if pixmap:
+            self.set_thumbnail(pixmap)
+
+    def set_thumbnail(self, pixmap):
+        self.image_label.setPixmap(pixmap)
+
+class ThumbnailLoader(QObject):
+    """Loads thumbnails on a thread pool, emitting each one as it's ready.
+
+    Finished thumbnails stay in an in-memory LRU in front of the disk cache,
+    so rebuilding the frame list after an edit or undo doesn't decode again.
+    """
+    thumbnail_ready = pyqtSignal(str, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.cache = ThumbnailCache()
+        self.executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        self.pixmaps = OrderedDict()
+        self.pending = set()
+        # Queued across threads, so the memory cache is only touched on the GUI thread
+        self.thumbnail_ready.connect(self.store)
+
+    def pixmap(self, image_path):
+        """The thumbnail if it's in memory, or None after queueing it to load."""
+        pixmap = self.pixmaps.get(image_path)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(image_path)
+            return pixmap
+        if image_path not in self.pending:
+            self.pending.add(image_path)
+            self.executor.submit(self.load, image_path)
+        return None
+
+    def load(self, image_path):
+        try:
+            image = to_qimage(self.cache.get(image_path))
+        except Exception:
+            # Unreadable files just keep an empty thumbnail
+            image = QImage()
+        self.thumbnail_ready.emit(image_path, image)
+
+    def store(self, image_path, image):
+        self.pending.discard(image_path)
+        if image.isNull():
+            return
+        self.pixmaps[image_path] = QPixmap.fromImage(image)
+        self.pixmaps.move_to_end(image_path)
+        while len(self.pixmaps) > THUMBNAIL_MEMORY_ITEMS:
+            self.pixmaps.popitem(last=False)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class PreviewCache(QObject):
+    """Preview frames scaled for the preview widget, decoded ahead of the playhead within a memory budget.
 
-    def load_thumbnail(self):
-        pixmap = QPixmap(self.image_path)
-        scaled_pixmap = pixmap.scaled(100, 100, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-        self.image_label.setPixmap(scaled_pixmap)
+    The GUI calls prefetch() with the frames it will show next, in order;
+    worker threads always take the first of them that isn't loaded yet, so a
+    jump of the playhead takes effect at once. When the budget is full the
+    frames outside the prefetch window are dropped first.
+    """
+    frame_ready = pyqtSignal(str, QImage, int)
+
+    def __init__(self, frame_cache=None, max_bytes=PREVIEW_CACHE_BYTES, workers=PREVIEW_WORKERS, parent=None):
+        super().__init__(parent)
+        self.frame_cache = frame_cache
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.box = (PREVIEW_SIZE_STEP, PREVIEW_SIZE_STEP)
+        # Bumped when the box changes, so frames still loading at the old size are dropped
+        self.generation = 0
+        self.window = []
+        self.failed = set()
+        self.condition = threading.Condition()
+        self.wanted = []
+        self.loading = set()
+        self.closed = False
+        self.frame_ready.connect(self.store)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def set_size(self, width, height):
+        """Size frames for a preview widget, rounded up to PREVIEW_SIZE_STEP."""
+        box = tuple(-(-max(1, side) // PREVIEW_SIZE_STEP) * PREVIEW_SIZE_STEP for side in (width, height))
+        if box != self.box:
+            with self.condition:
+                self.box = box
+                self.generation += 1
+                self.wanted = []
+            self.frames.clear()
+            self.bytes = 0
+            self.failed.clear()
+
+    def capacity(self):
+        """How many frames at the current size fit in the budget."""
+        return max(1, self.max_bytes // (self.box[0] * self.box[1] * 4))
+
+    def get(self, image_path):
+        pixmap = self.frames.get(image_path)
+        if pixmap is not None:
+            self.frames.move_to_end(image_path)
+        return pixmap
+
+    def prefetch(self, image_paths):
+        """Load these frames next, most urgent first, replacing the previous request."""
+        self.window = image_paths
+        with self.condition:
+            self.wanted = [path for path in dict.fromkeys(image_paths)
+                           if path not in self.frames and path not in self.failed]
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                image_path = None
+                while image_path is None:
+                    if self.closed:
+                        return
+                    while self.wanted and image_path is None:
+                        path = self.wanted.pop(0)
+                        # Frames still loading at an old size are wanted again
+                        if (path, self.generation) not in self.loading:
+                            image_path = path
+                    if image_path is None:
+                        self.condition.wait()
+                box, generation = self.box, self.generation
+                self.loading.add((image_path, generation))
+            try:
+                image = to_qimage(load_scaled(image_path, box, self.frame_cache))
+            except Exception:
+                image = QImage()
+            with self.condition:
+                self.loading.discard((image_path, generation))
+            self.frame_ready.emit(image_path, image, generation)
+
+    def store(self, image_path, image, generation):
+        if generation != self.generation:
+            return
+        if image.isNull():
+            self.failed.add(image_path)
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.frames[image_path] = pixmap
+        self.bytes += pixmap.width() * pixmap.height() * 4
+        window = set(self.window)
+        # Frames outside the prefetch window go first, least recently used first
+        for path in [path for path in self.frames if path not in window] + list(self.frames):
+            if self.bytes <= self.max_bytes:
+                break
+            if path in self.frames and path != image_path:
+                evicted = self.frames.pop(path)
+                self.bytes -= evicted.width() * evicted.height() * 4
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class ExportJob(QObject):
+    """Runs an export on a background thread, reporting progress and the outcome through signals."""
+    progress = pyqtSignal(int, int)
+    # Whether it completed, and the error if it failed
+    finished = pyqtSignal(bool, str)
+
+    def __init__(self, file_paths, output_path, parent=None, **options):
+        super().__init__(parent)
+        self.file_paths = file_paths
+        self.output_path = output_path
+        self.options = options
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            completed = export_animation(self.file_paths, self.output_path, progress=self.progress.emit,
+                                         cancel=self.cancel_event, **self.options)
+        except Exception as e:
+            self.finished.emit(False, str(e) or type(e).__name__)
+            return
+        self.finished.emit(completed, '')
 
 class GifCreatorApp(QMainWindow):
     def __init__(self):
@@ -148,6 +379,15 @@ class GifCreatorApp(QMainWindow):
         self.play_timer.timeout.connect(self.next_frame)
         self.undo_stack = []
         self.redo_stack = []
+        # Off until the Cache Frames toggle turns it on, like --cache on the command line tools
+        self.frame_cache = None
+        self.thumbnail_loader = ThumbnailLoader(self)
+        self.thumbnail_loader.thumbnail_ready.connect(self.on_thumbnail_ready)
+        # List items and thumbnail widgets waiting on each path's thumbnail
+        self.thumbnail_views = {}
+        self.preview_cache = PreviewCache(self.frame_cache, parent=self)
+        self.preview_cache.frame_ready.connect(self.on_preview_ready)
+        self.export_job = None
 
         self.init_ui()
         self.set_theme()
@@ -258,13 +498,22 @@ class GifCreatorApp(QMainWindow):
         self.optimize_toggle.setChecked(True)
         self.optimize_toggle.setToolTip("Toggle GIF optimization")
         optimization_layout.addWidget(self.optimize_toggle)
+
+        self.dither_toggle = ToggleButton("Dither")
+        self.dither_toggle.setToolTip("Ordered dither GIF frames to smooth gradients with fewer colours")
+        optimization_layout.addWidget(self.dither_toggle)
+
+        self.cache_toggle = ToggleButton("Cache Frames")
+        self.cache_toggle.setToolTip("Keep decoded DNG frames on disk so showing or exporting them again is faster")
+        self.cache_toggle.toggled.connect(self.set_frame_cache)
+        optimization_layout.addWidget(self.cache_toggle)
         
         optimization_layout.addWidget(QLabel("Quality:"))
         self.quality_slider = QSlider(Qt.Orientation.Horizontal)
         self.quality_slider.setRange(1, 100)
         self.quality_slider.setValue(85)
         self.quality_slider.setFixedWidth(200)
-        self.quality_slider.setToolTip("Adjust the quality of the GIF")
+        self.quality_slider.setToolTip("Adjust the quality: the number of GIF colours, or WebP compression")
         self.quality_label = QLabel("85")
         self.quality_slider.valueChanged.connect(self.update_quality_label)
         optimization_layout.addWidget(self.quality_slider)
@@ -303,8 +552,8 @@ class GifCreatorApp(QMainWindow):
         create_gif_layout = QHBoxLayout()
         create_gif_layout.addStretch()
         self.create_button = AnimatedButton("Create GIF")
-        self.create_button.clicked.connect(self.create_gif)
-        self.create_button.setToolTip("Create the GIF from selected images")
+        self.create_button.clicked.connect(self.toggle_export)
+        self.create_button.setToolTip("Create the GIF from selected images, or cancel the export in progress")
         create_gif_layout.addWidget(self.create_button)
         main_layout.addLayout(create_gif_layout)
 
@@ -590,9 +839,14 @@ class GifCreatorApp(QMainWindow):
 
     def update_image_list(self):
         self.image_list.clear()
+        self.thumbnail_views = {}
         for i, img in enumerate(self.images):
             item = QListWidgetItem(os.path.basename(img))
-            item.setIcon(QIcon(img))
+            pixmap = self.thumbnail_loader.pixmap(img)
+            if pixmap:
+                item.setIcon(QIcon(pixmap))
+            else:
+                self.thumbnail_views.setdefault(img, []).append(item)
             self.image_list.addItem(item)
         
         self.update_thumbnail_view()
@@ -602,19 +856,45 @@ class GifCreatorApp(QMainWindow):
         for i in reversed(range(self.thumbnail_layout.count())): 
             self.thumbnail_layout.itemAt(i).widget().setParent(None)
 
-        # Add new thumbnails
+        # Add new thumbnails; ones still loading are filled in by on_thumbnail_ready
         for i, img_path in enumerate(self.images):
-            thumbnail = ThumbnailWidget(img_path)
+            pixmap = self.thumbnail_loader.pixmap(img_path)
+            thumbnail = ThumbnailWidget(img_path, pixmap)
+            if not pixmap:
+                self.thumbnail_views.setdefault(img_path, []).append(thumbnail)
             row = i // 4
             col = i % 4
             self.thumbnail_layout.addWidget(thumbnail, row, col)
 
+    def on_thumbnail_ready(self, image_path, image):
+        pixmap = self.thumbnail_loader.pixmaps.get(image_path)
+        if pixmap is None:
+            return
+        for view in self.thumbnail_views.pop(image_path, []):
+            if isinstance(view, ThumbnailWidget):
+                view.set_thumbnail(pixmap)
+            else:
+                view.setIcon(QIcon(pixmap))
+
     def show_image(self, index):
         if 0 <= index < len(self.images):
-            pixmap = QPixmap(self.images[index])
+            self.preview_cache.set_size(self.preview_widget.width(), self.preview_widget.height())
+            # A frame that isn't decoded yet is shown by on_preview_ready; until then the last one stays up
+            pixmap = self.preview_cache.get(self.images[index])
             self.preview_widget.set_image(pixmap)
             self.current_image_index = index
             self.image_list.setCurrentRow(index)
+            self.prefetch_previews()
+
+    def prefetch_previews(self):
+        """Queue the frames from the playhead onwards, wrapping around as playback does."""
+        count = min(len(self.images), self.preview_cache.capacity())
+        self.preview_cache.prefetch([self.images[(self.current_image_index + i) % len(self.images)]
+                                     for i in range(count)])
+
+    def on_preview_ready(self, image_path, image, generation):
+        if self.images and self.images[self.current_image_index] == image_path:
+            self.preview_widget.set_image(self.preview_cache.get(image_path))
 
     def on_select_image(self):
         selected_items = self.image_list.selectedItems()
@@ -653,15 +933,7 @@ class GifCreatorApp(QMainWindow):
         self.show_image((self.current_image_index - 1) % len(self.images))
 
     def update_zoom(self, value):
-        if self.preview_widget.pixmap():
-            scale_factor = value / 100.0
-            original_pixmap = QPixmap(self.images[self.current_image_index])
-            scaled_pixmap = original_pixmap.scaled(
-                original_pixmap.size() * scale_factor,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
-            )
-            self.preview_widget.set_image(scaled_pixmap)
+        self.preview_widget.set_zoom(value / 100.0)
 
     def add_to_undo_stack(self, action):
         self.undo_stack.append(action)
@@ -685,7 +957,15 @@ class GifCreatorApp(QMainWindow):
             self.update_image_list()
             self.show_image(0)
 
+    def toggle_export(self):
+        if self.export_job:
+            self.export_job.cancel()
+        else:
+            self.create_gif()
+
     def create_gif(self):
+        if self.export_job:
+            return
         if not self.images:
             QMessageBox.warning(self, "No Images", "Please select images before creating a GIF.")
             return
@@ -697,52 +977,47 @@ class GifCreatorApp(QMainWindow):
         if output_file:
             self.progress_bar.setVisible(True)
             self.progress_bar.setValue(0)
-            
-            images = []
-            for i, file_name in enumerate(self.images):
-                if file_name.lower().endswith('.dng'):
-                    with rawpy.imread(file_name) as raw:
-                        img = raw.postprocess()
-                        img = Image.fromarray(img)
-                else:
-                    img = Image.open(file_name)
-                
-                if img.mode == 'RGBA':
-                    img = img.convert('RGB')
-                
-                # Apply resolution change if needed
-                resolution = self.resolution_combo.currentText()
-                if resolution != "Original":
-                    height = int(resolution[:-1])
-                    ratio = height / img.size[1]
-                    new_width = int(img.size[0] * ratio)
-                    img = img.resize((new_width, height), Image.LANCZOS)
-                
-                if self.optimize_toggle.isChecked():
-                    img = img.copy()
-                    img.thumbnail((800, 800), Image.LANCZOS)
-                
-                img_array = np.array(img)
-                images.append(img_array)
-                self.progress_bar.setValue(int((i + 1) / len(self.images) * 50))
-                QApplication.processEvents()
-
-            if images:
-                loop = self.loop_count_spin.value()
-                if output_format == 'gif':
-                    kwargs = {'fps': self.fps, 'loop': loop}
-                    if self.optimize_toggle.isChecked():
-                        kwargs['optimize'] = True
-                        kwargs['quality'] = self.quality_slider.value()
-                    
-                    imageio.mimsave(output_file, images, format='gif', **kwargs)
-                elif output_format == 'webp':
-                    kwargs = {'fps': self.fps, 'loop': loop, 'quality': self.quality_slider.value()}
-                    imageio.mimsave(output_file, images, format='webp', **kwargs)
-                
-                self.progress_bar.setValue(100)
-                QTimer.singleShot(1000, lambda: self.progress_bar.setVisible(False))
-                QMessageBox.information(self, "Success", f"{output_format.upper()} created successfully: {output_file}")
+            self.create_button.setText("Cancel")
+
+            resolution = self.resolution_combo.currentText()
+            self.export_job = ExportJob(
+                self.images.copy(), output_file, output_format=output_format, fps=self.fps,
+                loop=self.loop_count_spin.value(), quality=self.quality_slider.value(),
+                height=None if resolution == "Original" else int(resolution[:-1]),
+                optimize=self.optimize_toggle.isChecked(), dither=self.dither_toggle.isChecked(),
+                cache=self.frame_cache, parent=self)
+            self.export_job.progress.connect(self.on_export_progress)
+            self.export_job.finished.connect(self.on_export_finished)
+            self.export_job.start()
+
+    def set_frame_cache(self, enabled):
+        self.frame_cache = FrameCache() if enabled else None
+        self.preview_cache.frame_cache = self.frame_cache
+
+    def on_export_progress(self, done, total):
+        self.progress_bar.setValue(int(done / total * 100))
+
+    def on_export_finished(self, completed, error):
+        output_file = self.export_job.output_path
+        output_format = self.export_job.options['output_format']
+        self.export_job = None
+        self.create_button.setText("Create GIF")
+        if error:
+            self.progress_bar.setVisible(False)
+            QMessageBox.critical(self, "Error", f"Couldn't create {output_format.upper()}: {error}")
+        elif completed:
+            self.progress_bar.setValue(100)
+            QTimer.singleShot(1000, lambda: self.progress_bar.setVisible(False))
+            QMessageBox.information(self, "Success", f"{output_format.upper()} created successfully: {output_file}")
+        else:
+            self.progress_bar.setVisible(False)
+
+    def closeEvent(self, event):
+        if self.export_job:
+            self.export_job.cancel()
+        self.thumbnail_loader.close()
+        self.preview_cache.close()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -1,44 +1,285 @@
 import tkinter as tk
 from tkinter import filedialog
-import rawpy
-from PIL import Image
+import argparse
+import cv2
+import numpy as np
 import os
-import subprocess
+import signal
+import sys
+import glob
+import time
+import functools
+import threading
 import concurrent.futures
+from metadata import ExifTool, ExifToolError
+from frame_cache import FRAME_CACHE_DIR, FRAME_CACHE_LIMIT, FrameCache, cached_decode
+from raw_decode import DECODE_PROFILES, DEFAULT_PROFILE, create_executor, decode_raw
 
+# TIFF encoding and metadata threads; the decode processes do the heavy lifting
+WRITE_WORKERS = 2
 
-def desqueeze_image(file_path):
-    try:
-        # Load the DNG image using rawpy
-        with rawpy.imread(file_path) as raw:
-            # Use camera white balance for post-processing
-            rgb_array = raw.postprocess(use_camera_wb=True)
-            
-        # Convert to PIL image
-        img = Image.fromarray(rgb_array)
+# Frames each decode worker may have decoding or waiting to be written
+FRAMES_IN_FLIGHT_PER_WORKER = 2
+
+# Common anamorphic lens squeezes
+SQUEEZE_FACTORS = (1.33, 1.5, 1.8, 2.0)
+
+RESAMPLE_FILTERS = {
+    'nearest': cv2.INTER_NEAREST,
+    'bilinear': cv2.INTER_LINEAR,
+    'bicubic': cv2.INTER_CUBIC,
+    'lanczos': cv2.INTER_LANCZOS4,
+    'area': cv2.INTER_AREA,
+}
+
+OUTPUT_FORMATS = {'tiff': '.tiff', 'jpeg': '.jpg'}
+
+TIFF_COMPRESSIONS = {
+    'none': cv2.IMWRITE_TIFF_COMPRESSION_NONE,
+    'lzw': cv2.IMWRITE_TIFF_COMPRESSION_LZW,
+    'deflate': cv2.IMWRITE_TIFF_COMPRESSION_ADOBE_DEFLATE,
+}
+
+# Quality of JPEG output and proxies; JPEGs also keep full chroma resolution
+JPEG_QUALITY = 95
+
+# Longest side of the optional JPEG proxies
+PROXY_SIZE = 2048
+
+# Seconds between folder scans in watch mode
+WATCH_INTERVAL = 5
+
+
+def desqueeze_output_path(file_path, output_format='tiff'):
+    """Output file path with the suffix "-desqueezed"."""
+    base, ext = os.path.splitext(file_path)
+    return f"{base}-desqueezed{OUTPUT_FORMATS[output_format]}"
 
-        # Calculate the new width for the desqueezed image
-        original_width, original_height = img.size
-        new_width = int(original_width * 1.5)
+def proxy_output_path(file_path):
+    base, ext = os.path.splitext(file_path)
+    return f"{base}-desqueezed-proxy.jpg"
 
-        # Resize the image to desqueeze it
-        desqueezed_img = img.resize((new_width, original_height))
+def decode_desqueezed(file_path, squeeze=1.5, resample='bicubic', bit_depth=8, profile=DEFAULT_PROFILE, cache=None):
+    """Decode a DNG and stretch it to its desqueezed width. Runs in the decode worker processes."""
+    # The profile picks the demosaic; the bit depth always follows the output
+    options = {'profile': profile, 'output_bps': bit_depth}
+    rgb_array = cached_decode(cache, file_path, options, decode_raw)
 
-        # Create the output file path with the suffix "-desqueezed"
-        base, ext = os.path.splitext(file_path)
-        output_path = f"{base}-desqueezed.tiff"
+    # Calculate the new width for the desqueezed image
+    original_height, original_width = rgb_array.shape[:2]
+    new_width = int(original_width * squeeze)
 
-        # Save the desqueezed image as a TIFF file
-        desqueezed_img.save(output_path, format='TIFF')
+    # Resize straight from LibRaw's buffer (or the cached frame) into the output, with no intermediate image copy
+    return cv2.resize(rgb_array, (new_width, original_height), interpolation=RESAMPLE_FILTERS[resample])
 
-        # Copy metadata from the original file to the new file, ignoring minor errors
-        subprocess.run(['exiftool', '-TagsFromFile', file_path, '-all:all', '-overwrite_original', '-m', output_path])
+def encode_image(path, rgb_array, params):
+    """Encode an RGB array with OpenCV and write it, so non-ASCII paths work on Windows too."""
+    # OpenCV expects BGR; the array is ours, so swap the channels in place
+    bgr_array = cv2.cvtColor(rgb_array, cv2.COLOR_RGB2BGR, dst=rgb_array)
+    ok, encoded = cv2.imencode(os.path.splitext(path)[1], bgr_array, params)
+    if not ok:
+        raise ValueError(f"Couldn't encode {path}")
+    with open(path, 'wb') as f:
+        f.write(encoded)
 
-        print(f"Saved desqueezed image to: {output_path}")
+def make_proxy(rgb_array, size=PROXY_SIZE):
+    """Small 8-bit copy of a desqueezed image for quick review."""
+    height, width = rgb_array.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    proxy = cv2.resize(rgb_array, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    if proxy.dtype != np.uint8:
+        proxy = (proxy >> 8).astype(np.uint8)
+    return proxy
+
+def write_desqueezed(file_path, rgb_array, output_format='tiff', compression='deflate',
+                     jpeg_quality=JPEG_QUALITY, proxy=False, exiftool=None):
+    """Save a desqueezed image (and its proxy) and copy the DNG's metadata, returning an error message or None."""
+    output_paths = [desqueeze_output_path(file_path, output_format)]
+    try:
+        if proxy:
+            output_paths.append(proxy_output_path(file_path))
+            proxy_array = make_proxy(rgb_array)
+        if output_format == 'jpeg':
+            params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality,
+                      cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+        else:
+            params = [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSIONS[compression]]
+            if compression != 'none':
+                # Horizontal differencing makes photos compress much better
+                params += [cv2.IMWRITE_TIFF_PREDICTOR, 2]
+        # Save the desqueezed image
+        encode_image(output_paths[0], rgb_array, params)
+        if proxy:
+            encode_image(output_paths[1], proxy_array, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        print(f"Saved desqueezed image to: {output_paths[0]}")
     except Exception as e:
         print(f"Failed to process {file_path}: {e}")
+        return str(e)
+
+    if exiftool is not None:
+        # Copy metadata from the original file to the new files, ignoring minor errors
+        for output_path in output_paths:
+            try:
+                exiftool.copy_metadata(file_path, output_path)
+            except ExifToolError as e:
+                print(f"Failed to copy metadata to {output_path}: {e}")
+                return f"metadata: {e}"
+    return None
+
+def ignore_interrupts():
+    """Leave Ctrl+C to the main process, which stops queueing files and lets the workers finish."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class DesqueezePipeline:
+    """Decode processes and writer threads that DNGs can be fed into as they arrive.
+
+    Frames are stretched ``squeeze`` times wider with the ``resample`` filter
+    and saved as ``output_format``: 8 or 16-bit TIFF (uncompressed, LZW or
+    deflate) or JPEG, optionally with a small JPEG proxy next to each one.
+    ``profile`` picks the raw_decode profile; a 'preview' decode is half size.
+    Decoded frames are kept in and reused from a FrameCache passed as ``cache``.
+
+    Decoding and resizing run in a process pool so they scale past the GIL,
+    while a small thread pool encodes the TIFFs and copies metadata. At most
+    ``frames_in_flight`` frames are decoding or waiting to be written at once,
+    so ``submit`` blocks rather than letting memory grow however many files
+    there are. The pools stay up until ``close``, which returns
+    {file path: error} for the files that failed.
+    """
+
+    def __init__(self, squeeze=1.5, resample='bicubic', output_format='tiff', bit_depth=8,
+                 compression='deflate', jpeg_quality=JPEG_QUALITY, proxy=False, profile=DEFAULT_PROFILE, cache=None,
+                 decode_workers=None, write_workers=WRITE_WORKERS, frames_in_flight=None, exiftool=None):
+        if squeeze < 1:
+            raise ValueError(f"Squeeze factor must be at least 1, not {squeeze}")
+        if resample not in RESAMPLE_FILTERS:
+            raise ValueError(f"Unknown resample filter: {resample}")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        if bit_depth not in (8, 16) or (output_format == 'jpeg' and bit_depth != 8):
+            raise ValueError(f"Can't write {bit_depth}-bit {output_format.upper()} files")
+        if compression not in TIFF_COMPRESSIONS:
+            raise ValueError(f"Unknown TIFF compression: {compression}")
+        if profile not in DECODE_PROFILES:
+            raise ValueError(f"Unknown decode profile: {profile}")
+        self.decode_options = {'squeeze': squeeze, 'resample': resample, 'bit_depth': bit_depth,
+                               'profile': profile, 'cache': cache}
+        self.write_options = {'output_format': output_format, 'compression': compression,
+                              'jpeg_quality': jpeg_quality, 'proxy': proxy, 'exiftool': exiftool}
+        decode_workers = decode_workers or os.cpu_count() or 1
+        frames_in_flight = frames_in_flight or decode_workers * FRAMES_IN_FLIGHT_PER_WORKER
+        self.slots = threading.Semaphore(frames_in_flight)
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.decoders = create_executor(decode_workers, initializer=ignore_interrupts)
+        self.writers = concurrent.futures.ThreadPoolExecutor(write_workers)
+
+    def submit(self, file_path):
+        """Queue a DNG, waiting first if too many frames are already in flight."""
+        self.slots.acquire()
+        future = self.decoders.submit(decode_desqueezed, file_path, **self.decode_options)
+        future.add_done_callback(functools.partial(self.decoded, file_path))
 
-def main():
+    def decoded(self, file_path, future):
+        try:
+            rgb_array = future.result()
+        except Exception as e:
+            print(f"Failed to process {file_path}: {e}")
+            self.finished(file_path, str(e))
+            return
+        self.writers.submit(self.write, file_path, rgb_array)
+
+    def write(self, file_path, rgb_array):
+        error = None
+        try:
+            error = write_desqueezed(file_path, rgb_array, **self.write_options)
+        finally:
+            self.finished(file_path, error)
+
+    def finished(self, file_path, error):
+        with self.lock:
+            if error is not None:
+                self.failures[file_path] = error
+        # Let the decoders start on another frame
+        self.slots.release()
+
+    def close(self):
+        """Wait for every queued file, returning {file path: error} for those that failed."""
+        # Decode callbacks have all handed their frames to the writers once the pool is down
+        self.decoders.shutdown()
+        self.writers.shutdown()
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def desqueeze_files(file_paths, **options):
+    """Desqueeze DNGs with a DesqueezePipeline, returning {file path: error} for the files that failed."""
+    pipeline = DesqueezePipeline(**options)
+    try:
+        for file_path in file_paths:
+            pipeline.submit(file_path)
+    finally:
+        failures = pipeline.close()
+    return failures
+
+def find_dngs(paths, recursive=False):
+    """DNG files named by files, folders and glob patterns, in a stable order."""
+    file_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for folder, _, names in os.walk(path):
+                    file_paths.extend(os.path.join(folder, name) for name in names)
+            else:
+                file_paths.extend(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            file_paths.extend(glob.glob(path, recursive=recursive))
+    return sorted(set(os.path.abspath(file_path) for file_path in file_paths
+                      if file_path.lower().endswith('.dng') and os.path.isfile(file_path)))
+
+def is_up_to_date(file_path, output_format='tiff'):
+    """Whether the desqueezed output exists and is newer than its DNG."""
+    output_path = desqueeze_output_path(file_path, output_format)
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(file_path)
+    except OSError:
+        return False
+
+def watch(paths, pipeline, recursive=False, output_format='tiff', force=False, interval=WATCH_INTERVAL):
+    """Feed new DNGs into the pipeline as they appear, until interrupted.
+
+    A file is only queued once its size and modification time have stayed the
+    same for one ``interval``, so files still being copied off a card are left alone.
+    """
+    print(f"Watching {', '.join(paths)} for new DNGs, press Ctrl+C to stop")
+    queued = set()
+    last_seen = {}
+    while True:
+        for file_path in find_dngs(paths, recursive):
+            if file_path in queued:
+                continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if last_seen.get(file_path) != signature:
+                last_seen[file_path] = signature
+                continue
+            del last_seen[file_path]
+            queued.add(file_path)
+            if force or not is_up_to_date(file_path, output_format):
+                print(f"Queued {file_path}")
+                pipeline.submit(file_path)
+        time.sleep(interval)
+
+def ask_for_files():
+    """Pick DNG files in a dialog, for when no paths are given on the command line."""
     # Create a Tkinter root window (it won't be shown)
     root = tk.Tk()
     root.withdraw()  # Hide the root window
@@ -48,14 +289,85 @@ def main():
         title="Select DNG files",
         filetypes=[("DNG files", "*.dng")]
     )
+    root.destroy()
+    return list(file_paths)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Desqueeze anamorphic DNGs. Without paths, files are picked in a dialog.")
+    parser.add_argument('paths', nargs='*', help="DNG files, folders or glob patterns")
+    parser.add_argument('-r', '--recursive', action='store_true', help="look for DNGs in subfolders too")
+    parser.add_argument('--force', action='store_true', help="desqueeze files whose output is already up to date")
+    parser.add_argument('--watch', action='store_true', help="keep desqueezing new DNGs as they arrive in the folders")
+    parser.add_argument('--watch-interval', type=float, default=WATCH_INTERVAL, help="seconds between folder scans")
+    parser.add_argument('--squeeze', type=float, default=1.5,
+                        help=f"lens squeeze factor, e.g. {', '.join(map(str, SQUEEZE_FACTORS))}")
+    parser.add_argument('--resample', default='bicubic', choices=list(RESAMPLE_FILTERS), help="resampling filter")
+    parser.add_argument('--format', dest='output_format', default='tiff', choices=list(OUTPUT_FORMATS),
+                        help="output file format")
+    parser.add_argument('--bit-depth', type=int, default=8, choices=(8, 16), help="TIFF bit depth")
+    parser.add_argument('--compression', default='deflate', choices=list(TIFF_COMPRESSIONS), help="TIFF compression")
+    parser.add_argument('--jpeg-quality', type=int, default=JPEG_QUALITY, help="JPEG quality for JPEGs and proxies")
+    parser.add_argument('--proxy', action='store_true', help=f"also save a {PROXY_SIZE}px JPEG proxy of each image")
+    parser.add_argument('--profile', default=DEFAULT_PROFILE, choices=list(DECODE_PROFILES),
+                        help="RAW decode profile; 'preview' decodes at half size")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep decoded frames on disk so another pass over the same files skips decoding")
+    parser.add_argument('--cache-dir', default=FRAME_CACHE_DIR, help="decoded frame cache folder")
+    parser.add_argument('--cache-limit', type=float, default=FRAME_CACHE_LIMIT / 1024 ** 3,
+                        help="decoded frame cache size in GB; the least recently used frames go first")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="decode worker processes")
+    parser.add_argument('--write-workers', type=int, default=WRITE_WORKERS, help="encoding and metadata threads")
+    parser.add_argument('--in-flight', type=int, help="most frames decoding or waiting to be written at once")
+    args = parser.parse_args(argv)
 
-    # Use ThreadPoolExecutor to process images in parallel
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(desqueeze_image, file_path) for file_path in file_paths]
-        for future in concurrent.futures.as_completed(futures):
-            future.result()  # To raise any exception that occurred during processing
+    if args.watch and not args.paths:
+        parser.error("--watch needs folders to watch")
+    if args.paths:
+        file_paths = [] if args.watch else find_dngs(args.paths, args.recursive)
+    else:
+        # Files picked by hand are always desqueezed
+        file_paths = ask_for_files()
+    if args.paths and not args.force:
+        skipped = set(file_path for file_path in file_paths if is_up_to_date(file_path, args.output_format))
+        if skipped:
+            print(f"Skipping {len(skipped)} files that are already desqueezed")
+            file_paths = [file_path for file_path in file_paths if file_path not in skipped]
+
+    # One exiftool process copies the metadata for every file
+    try:
+        exiftool = ExifTool()
+    except OSError as e:
+        print(f"Couldn't start exiftool, metadata won't be copied: {e}")
+        exiftool = None
+
+    pipeline = DesqueezePipeline(
+        squeeze=args.squeeze, resample=args.resample, output_format=args.output_format,
+        bit_depth=args.bit_depth, compression=args.compression, jpeg_quality=args.jpeg_quality,
+        proxy=args.proxy, profile=args.profile,
+        cache=FrameCache(args.cache_dir, int(args.cache_limit * 1024 ** 3)) if args.cache else None,
+        decode_workers=args.workers, write_workers=args.write_workers,
+        frames_in_flight=args.in_flight, exiftool=exiftool)
+    try:
+        if args.watch:
+            try:
+                watch(args.paths, pipeline, args.recursive, args.output_format, args.force, args.watch_interval)
+            except KeyboardInterrupt:
+                print("Stopped watching, finishing queued files...")
+        else:
+            for file_path in file_paths:
+                pipeline.submit(file_path)
+    finally:
+        failures = pipeline.close()
+        if exiftool is not None:
+            exiftool.close()
 
-    print("Complete")
+    if failures:
+        print(f"Complete, {len(failures)} files failed:")
+        for file_path, error in failures.items():
+            print(f"  {file_path}: {error}")
+    else:
+        print("Complete")
+    return 1 if failures else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,61 +1,592 @@
+import argparse
 import cv2
+import multiprocessing
 import numpy as np
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import tkinter as tk
 from tkinter import filedialog
 
-def apply_motion_blur(video_path, output_path):
+# Frames each queue between the reader, compute and writer stages can hold
+PIPELINE_QUEUE_SIZE = 8
+
+# Buffers each stage pool needs beyond the queue: one being filled and one being used
+BUFFERS_PER_STAGE = PIPELINE_QUEUE_SIZE + 2
+
+# Frames decoded up front for the benchmark, so only the blur is timed
+BENCHMARK_FRAMES = 120
+
+# Share of the EMA history before a segment that may be left out of its first
+# frame; the frames blurred only to prime the filter are derived from it and the
+# weight, e.g. 31 at the default 0.2 and 227 at 0.03
+SEGMENT_WARMUP_RESIDUAL = 0.001
+
+# Filter settings compared by the benchmark, as MotionBlur arguments
+BENCHMARK_FILTERS = {
+    'ema + gaussian': {},
+    'ema + box': {'spatial': 'box'},
+    'ema + gaussian 1/2': {'scale': 0.5},
+    'ema + gaussian 1/4': {'scale': 0.25},
+    'ema only': {'spatial': 'none'},
+    'box 5 + gaussian': {'temporal': 'box', 'window': 5},
+    'box 15 + gaussian': {'temporal': 'box', 'window': 15},
+    'shutter 720 + gaussian': {'temporal': 'shutter', 'shutter_angle': 720},
+    'shutter 1800 + gaussian': {'temporal': 'shutter', 'shutter_angle': 1800},
+}
+
+class EmaFilter:
+    """Exponential moving average: each frame adds ``weight`` of itself to the running average."""
+
+    def __init__(self, shape, weight=0.2):
+        self.weight = weight
+        self.average = np.empty(shape, dtype=np.float32)
+        self.primed = False
+
+    def apply(self, frame):
+        if self.primed:
+            # average = (1 - weight) * average + weight * frame, in place and straight from uint8
+            cv2.accumulateWeighted(frame, self.average, self.weight)
+        else:
+            np.copyto(self.average, frame)
+            self.primed = True
+        return self.average
+
+class BoxAverageFilter:
+    """Plain average of the last ``window`` frames, kept in a ring buffer.
+
+    An integer running sum gains the new frame and loses the one leaving the
+    ring, so the cost per frame doesn't grow with the window and never drifts.
+    """
+
+    def __init__(self, shape, window=5):
+        self.ring = np.zeros((window,) + tuple(shape), dtype=np.uint8)
+        self.total = np.zeros(shape, dtype=np.int32)
+        self.average = np.empty(shape, dtype=np.float32)
+        self.count = 0
+
+    def apply(self, frame):
+        slot = self.count % len(self.ring)
+        if self.count >= len(self.ring):
+            np.subtract(self.total, self.ring[slot], out=self.total)
+        np.add(self.total, frame, out=self.total)
+        np.copyto(self.ring[slot], frame)
+        self.count += 1
+        np.multiply(self.total, np.float32(1 / min(self.count, len(self.ring))), out=self.average, casting='unsafe')
+        return self.average
+
+class ShutterFilter:
+    """Emulates a shutter open for ``shutter_angle`` degrees, 360 being one frame time.
+
+    Each recent frame is weighted by how much of its frame time falls inside
+    the open shutter, so 900 degrees means two and a half frames: the last
+    two in full and half of the one before.
+    """
+
+    def __init__(self, shape, shutter_angle=720):
+        frames = shutter_angle / 360
+        if frames <= 0:
+            raise ValueError(f"Shutter angle must be positive, not {shutter_angle}")
+        # Newest frame first
+        self.weights = [min(1.0, frames - k) for k in range(int(np.ceil(frames)))]
+        self.ring = np.zeros((len(self.weights),) + tuple(shape), dtype=np.uint8)
+        self.average = np.empty(shape, dtype=np.float32)
+        self.count = 0
+
+    def apply(self, frame):
+        np.copyto(self.ring[self.count % len(self.ring)], frame)
+        self.count += 1
+        total_weight = 0.0
+        for k, weight in enumerate(self.weights[:self.count]):
+            past_frame = self.ring[(self.count - 1 - k) % len(self.ring)]
+            total_weight += weight
+            if k == 0:
+                np.copyto(self.average, past_frame)
+            else:
+                # Folding each frame into a weighted mean keeps it to one in-place call
+                cv2.accumulateWeighted(past_frame, self.average, weight / total_weight)
+        return self.average
+
+TEMPORAL_FILTERS = {'ema': EmaFilter, 'box': BoxAverageFilter, 'shutter': ShutterFilter}
+
+class SpatialBlur:
+    """Gaussian or box blur of a float32 image, optionally done at ``scale`` of the resolution.
+
+    A box blur costs the same for any kernel size. Blurring at half scale
+    does a quarter of the work, and the result is smooth anyway, so
+    upsampling it again loses little.
+    """
+
+    def __init__(self, shape, kind='gaussian', kernel_size=15, scale=1.0):
+        if kind not in SPATIAL_FILTERS:
+            raise ValueError(f"Unknown spatial filter: {kind}")
+        if not 0 < scale <= 1:
+            raise ValueError(f"Scale must be between 0 and 1, not {scale}")
+        self.kind = kind
+        height, width = shape[:2]
+        self.small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        self.scaled = self.small_size != (width, height)
+        # Odd kernels keep the blur centred
+        self.kernel_size = max(1, round(kernel_size * scale)) | 1
+        self.small = np.empty((self.small_size[1], self.small_size[0]) + tuple(shape[2:]), dtype=np.float32)
+        self.small_blurred = np.empty_like(self.small)
+        self.blurred = np.empty(shape, dtype=np.float32)
+
+    def apply(self, image):
+        if self.kind == 'none':
+            return image
+        source, target = image, self.blurred
+        if self.scaled:
+            cv2.resize(image, self.small_size, dst=self.small, interpolation=cv2.INTER_AREA)
+            source, target = self.small, self.small_blurred
+        kernel = (self.kernel_size, self.kernel_size)
+        if self.kind == 'gaussian':
+            cv2.GaussianBlur(source, kernel, 0, dst=target)
+        else:
+            cv2.blur(source, kernel, dst=target)
+        if self.scaled:
+            cv2.resize(target, (image.shape[1], image.shape[0]), dst=self.blurred, interpolation=cv2.INTER_LINEAR)
+        return self.blurred
+
+SPATIAL_FILTERS = ('gaussian', 'box', 'none')
+
+class MotionBlur:
+    """A temporal filter across frames followed by a spatial blur.
+
+    All the intermediate images live in buffers allocated once, and every
+    OpenCV call writes into them through ``dst``, so a frame costs no
+    allocations. The defaults are the original 0.2 EMA and 15x15 Gaussian.
+    ``weight`` applies to the EMA, ``window`` to the box average and
+    ``shutter_angle`` to the shutter emulation.
+    """
+
+    def __init__(self, shape, temporal='ema', spatial='gaussian', kernel_size=15, scale=1.0,
+                 weight=0.2, window=5, shutter_angle=720):
+        if temporal == 'ema':
+            self.temporal = EmaFilter(shape, weight)
+        elif temporal == 'box':
+            self.temporal = BoxAverageFilter(shape, window)
+        elif temporal == 'shutter':
+            self.temporal = ShutterFilter(shape, shutter_angle)
+        else:
+            raise ValueError(f"Unknown temporal filter: {temporal}")
+        self.spatial = SpatialBlur(shape, spatial, kernel_size, scale)
+
+    def apply(self, frame, out):
+        """Blur the next uint8 frame into the uint8 ``out`` buffer and return it."""
+        blurred = self.spatial.apply(self.temporal.apply(frame))
+        # Truncates like astype(np.uint8) did
+        np.copyto(out, blurred, casting='unsafe')
+        return out
+
+def allocating_motion_blur(frame, state):
+    """The original per-frame blur, allocating every intermediate, kept as the benchmark baseline."""
+    frame_f32 = frame.astype(np.float32)
+    if state.get('average') is None:
+        state['average'] = frame_f32
+    else:
+        state['average'] = cv2.addWeighted(frame_f32, 0.2, state['average'], 0.8, 0)
+    blurred_frame = cv2.GaussianBlur(state['average'], (15, 15), 0)
+    return blurred_frame.astype(np.uint8)
+
+def read_frames(cap, frames, free_frames, stage_times, stop, frame_limit=None):
+    """Reader stage: decode up to ``frame_limit`` frames into recycled buffers and queue them, ending with None."""
+    try:
+        frame_count = 0
+        while not stop.is_set() and (frame_limit is None or frame_count < frame_limit):
+            frame_count += 1
+            buffer = free_frames.get()
+            start = time.perf_counter()
+            ret, frame = cap.read(buffer)
+            stage_times['read'] += time.perf_counter() - start
+            if not ret:
+                break
+            frames.put(frame)
+    finally:
+        frames.put(None)
+
+def write_frames(out, frames, free_frames, stage_times, errors):
+    """Writer stage: encode frames from the queue until None, keeping any error for the compute stage."""
+    while True:
+        frame = frames.get()
+        if frame is None:
+            return
+        # Keep draining after an error so the compute stage never blocks on a full queue
+        if not errors:
+            try:
+                start = time.perf_counter()
+                out.write(frame)
+                stage_times['write'] += time.perf_counter() - start
+            except Exception as e:
+                errors.append(e)
+        free_frames.put(frame)
+
+def buffer_pool(shape, count):
+    """Queue of ``count`` preallocated uint8 frames for a stage to take from and give back."""
+    pool = queue.Queue()
+    for _ in range(count):
+        pool.put(np.empty(shape, dtype=np.uint8))
+    return pool
+
+def apply_motion_blur(video_path, output_path, start=0, end=None, warmup=0, **blur_options):
+    """Blur a video, with reading, blurring and writing overlapping on their own threads.
+
+    ``blur_options`` are MotionBlur arguments picking the filters.
+    Only frames ``start`` to ``end`` are written; up to ``warmup`` frames
+    before ``start`` are blurred first to prime the temporal filter.
+    Frames cycle through fixed pools of buffers, so memory use is flat. Returns
+    the frames per second each stage could sustain on its own, and overall.
+    """
     cap = cv2.VideoCapture(video_path)
-    
+
     if not cap.isOpened():
-        print("Error: Couldn't open the video file.")
-        return
-    
+        raise IOError(f"Couldn't open the video file {video_path}")
+
+    first_frame = max(0, start - warmup)
+    if first_frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+    warmup = start - first_frame
+
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = int(cap.get(cv2.CAP_PROP_FPS))
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    
+
     out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-    
+
     frame_count = 0
-    avg_frame = None
-    
+    shape = (height, width, 3)
+    motion_blur = MotionBlur(shape, **blur_options)
+
+    # OpenCV releases the GIL while decoding, blurring and encoding, so the stages really overlap
+    stage_times = {'read': 0.0, 'blur': 0.0, 'write': 0.0}
+    read_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    write_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    free_inputs = buffer_pool(shape, BUFFERS_PER_STAGE)
+    free_outputs = buffer_pool(shape, BUFFERS_PER_STAGE)
+    stop = threading.Event()
+    write_errors = []
+    frame_limit = None if end is None else end - first_frame
+    reader = threading.Thread(target=read_frames, args=(cap, read_queue, free_inputs, stage_times, stop, frame_limit),
+                              daemon=True)
+    writer = threading.Thread(target=write_frames, args=(out, write_queue, free_outputs, stage_times, write_errors),
+                              daemon=True)
+    start_time = time.perf_counter()
+    reader.start()
+    writer.start()
+
+    try:
+        while True:
+            frame = read_queue.get()
+
+            if frame is None:
+                break
+
+            output = free_outputs.get()
+            blur_start = time.perf_counter()
+            frame_count += 1
+            motion_blur.apply(frame, output)
+            stage_times['blur'] += time.perf_counter() - blur_start
+            free_inputs.put(frame)
+
+            if frame_count <= warmup:
+                free_outputs.put(output)
+                continue
+            write_queue.put(output)
+            if write_errors:
+                raise write_errors[0]
+    finally:
+        # Unblock the reader if it is waiting on a full queue or for a free buffer
+        stop.set()
+        while reader.is_alive():
+            try:
+                frame = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if frame is not None:
+                free_inputs.put(frame)
+        write_queue.put(None)
+        writer.join()
+        cap.release()
+        out.release()
+    if write_errors:
+        raise write_errors[0]
+
+    frame_count -= min(frame_count, warmup)
+    elapsed = time.perf_counter() - start_time
+    stage_fps = {stage: frame_count / seconds if seconds else float('inf') for stage, seconds in stage_times.items()}
+    stage_fps['overall'] = frame_count / elapsed if elapsed else float('inf')
+    print(f"Processed video saved at {output_path}")
+    print("Frames/s: " + ", ".join(f"{stage} {rate:.1f}" for stage, rate in stage_fps.items()))
+    return stage_fps
+
+def smoothed_output_path(video_path, output_dir=None, taken=()):
+    """Output path named after the input, avoiding the normcased paths in ``taken``.
+
+    Inputs that would share a name, like clip.mp4 and clip.mov, or two clip.mp4
+    from different folders with one output folder, keep their extension in the
+    name and then get a number, so parallel jobs never write the same file.
+    """
+    base, extension = os.path.splitext(os.path.basename(video_path))
+    folder = output_dir or os.path.dirname(os.path.abspath(video_path))
+    names = [f"{base}_smoothed.mp4"]
+    if extension:
+        names.append(f"{base}_{extension.lstrip('.')}_smoothed.mp4")
+    for name in names:
+        output_path = os.path.join(folder, name)
+        if os.path.normcase(os.path.abspath(output_path)) not in taken:
+            return output_path
+    number = 2
     while True:
-        ret, frame = cap.read()
-        
-        if not ret:
-            break
-            
+        output_path = os.path.join(folder, f"{os.path.splitext(names[-1])[0]}_{number}.mp4")
+        if os.path.normcase(os.path.abspath(output_path)) not in taken:
+            return output_path
+        number += 1
+
+def open_packets(video_path):
+    """Capture that returns encoded packets instead of decoded frames."""
+    return cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+
+def find_keyframes(video_path):
+    """Indices of a video's keyframes and its frame count, from the packets without decoding them."""
+    cap = open_packets(video_path)
+    if not cap.isOpened():
+        raise IOError(f"Couldn't open the video file {video_path}")
+    keyframes = []
+    frame_count = 0
+    while cap.grab():
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(frame_count)
         frame_count += 1
-        frame_f32 = frame.astype(np.float32)
-        
-        if avg_frame is None:
-            avg_frame = frame_f32
+    cap.release()
+    return keyframes, frame_count
+
+def plan_segments(video_path, segments):
+    """Split a video into up to ``segments`` (start, end) frame ranges that begin on keyframes."""
+    keyframes, frame_count = find_keyframes(video_path)
+    starts = {0}
+    for i in range(1, segments):
+        target = frame_count * i / segments
+        starts.add(min(keyframes, key=lambda keyframe: abs(keyframe - target), default=0))
+    starts = sorted(starts)
+    return list(zip(starts, starts[1:] + [frame_count]))
+
+def concatenate_videos(part_paths, output_path):
+    """Join videos encoded with the same settings by copying their packets, without re-encoding."""
+    cap = cv2.VideoCapture(part_paths[0])
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    cap.release()
+    out = cv2.VideoWriter(output_path, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height),
+                          [cv2.VIDEOWRITER_PROP_RAW_VIDEO, 1])
+    if not out.isOpened():
+        raise IOError(f"Couldn't create {output_path}")
+    try:
+        for part_path in part_paths:
+            cap = open_packets(part_path)
+            # Each part has its own codec header, which the raw packets leave out
+            ok, extradata = cap.retrieve(flag=int(cap.get(cv2.CAP_PROP_CODEC_EXTRADATA_INDEX)))
+            while cap.grab():
+                ok, packet = cap.retrieve()
+                keyframe = bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME))
+                if keyframe and extradata is not None and extradata.size:
+                    packet = np.concatenate([extradata.ravel(), packet.ravel()])
+                out.set(cv2.VIDEOWRITER_PROP_KEY_FLAG, int(keyframe))
+                out.write(packet)
+            cap.release()
+    finally:
+        out.release()
+
+def set_opencv_threads(threads):
+    """Share the cores between the worker processes instead of each one using all of them."""
+    cv2.setNumThreads(threads)
+
+def segment_warmup(temporal='ema', weight=0.2, window=5, shutter_angle=720, **blur_options):
+    """Frames to blur before a segment so its first frame matches a whole-file run.
+
+    Only the ``temporal`` filter in use counts. The EMA needs enough frames for
+    the skipped history to fall under SEGMENT_WARMUP_RESIDUAL; the box and
+    shutter filters need their whole window.
+    """
+    if temporal == 'box':
+        return window
+    if temporal == 'shutter':
+        return int(np.ceil(shutter_angle / 360))
+    return int(np.ceil(np.log(SEGMENT_WARMUP_RESIDUAL) / np.log(1 - weight))) if 0 < weight < 1 else 1
+
+def smooth_videos(video_paths, workers=None, segments=1, output_dir=None, **blur_options):
+    """Motion blur several videos at once in a process pool, returning {video: output path or exception}.
+
+    ``blur_options`` are MotionBlur arguments picking the filters.
+    With ``segments`` above 1 each video is also split at keyframes into that
+    many parts, processed in parallel with segment_warmup() frames of overlap
+    and joined again, so a single long clip uses every worker too.
+    """
+    workers = workers or os.cpu_count() or 1
+    warmup = segment_warmup(**blur_options)
+    jobs = {}
+    taken = set()
+    for video_path in video_paths:
+        if video_path in jobs:
+            continue
+        # Part files are named after the output too, so they are unique to the job as well
+        output_path = smoothed_output_path(video_path, output_dir, taken)
+        taken.add(os.path.normcase(os.path.abspath(output_path)))
+        if segments > 1:
+            ranges = plan_segments(video_path, segments)
+        else:
+            ranges = [(0, None)]
+        if len(ranges) == 1:
+            jobs[video_path] = (output_path, [(output_path, 0, None)])
         else:
-            avg_frame = cv2.addWeighted(frame_f32, 0.2, avg_frame, 0.8, 0)
-        
-        blurred_frame = cv2.GaussianBlur(avg_frame, (15, 15), 0)
-        
-        out.write(blurred_frame.astype(np.uint8))
+            base = os.path.splitext(output_path)[0]
+            jobs[video_path] = (output_path, [(f"{base}.part{i:03d}.mp4", start, end)
+                                              for i, (start, end) in enumerate(ranges)])
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=set_opencv_threads,
+                             initargs=(max(1, (os.cpu_count() or 1) // workers),)) as executor:
+        futures = {}
+        for video_path, (output_path, parts) in jobs.items():
+            for part_path, start, end in parts:
+                future = executor.submit(apply_motion_blur, video_path, part_path, start, end, warmup, **blur_options)
+                futures[future] = video_path
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to process {futures[future]}: {e}")
+                results[futures[future]] = e
+
+    for video_path, (output_path, parts) in jobs.items():
+        part_paths = [part_path for part_path, _, _ in parts]
+        try:
+            if video_path not in results and len(parts) > 1:
+                concatenate_videos(part_paths, output_path)
+                print(f"Joined {len(parts)} segments into {output_path}")
+        except Exception as e:
+            print(f"Failed to join the segments of {video_path}: {e}")
+            results[video_path] = e
+        finally:
+            if len(parts) > 1:
+                for part_path in part_paths:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+        results.setdefault(video_path, output_path)
+    return results
+
+def measure_blur(frames, blur):
+    """Frames/s and bytes allocated per frame while ``blur(frame)`` runs over the frames."""
+    allocated = 0
+    elapsed = 0.0
+    tracemalloc.start()
+    try:
+        for frame in frames:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            blur(frame)
+            elapsed += time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            allocated += peak - before
+    finally:
+        tracemalloc.stop()
+    return len(frames) / elapsed, allocated / len(frames)
 
+def benchmark(video_path, frame_limit=BENCHMARK_FRAMES, filters=BENCHMARK_FILTERS):
+    """Compare the blur filters on frames of a video, starting from the original allocating blur.
+
+    Reports frames/s, the memory each frame allocates and the PSNR against
+    the default EMA and Gaussian, which shows how far a cheaper filter strays
+    from the default look. NumPy reports its buffers to tracemalloc, so the
+    memory a frame needs beyond what it started with counts the temporaries
+    it allocated. Frames are decoded first so only the blur is timed;
+    tracing slows every filter a little.
+    """
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < frame_limit:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
     cap.release()
-    out.release()
-    print(f"Processed video saved at {output_path}")
+    if not frames:
+        raise ValueError(f"Couldn't read any frames from {video_path}")
+
+    reference = []
+    motion_blur = MotionBlur(frames[0].shape)
+    for frame in frames:
+        reference.append(motion_blur.apply(frame, np.empty_like(frame)))
+
+    state = {}
+    outputs = []
+    runs = {'allocating (original)': lambda frame: outputs.append(allocating_motion_blur(frame, state))}
+    for name, options in filters.items():
+        def run(frame, motion_blur=MotionBlur(frames[0].shape, **options), output=np.empty_like(frames[0])):
+            outputs.append(motion_blur.apply(frame, output).copy())
+        runs[name] = run
+
+    results = {}
+    for name, run in runs.items():
+        outputs.clear()
+        frames_per_second, bytes_per_frame = measure_blur(frames, run)
+        # The copies kept for the PSNR are counted too, so take them out again
+        if name in filters:
+            bytes_per_frame -= frames[0].nbytes
+        psnr = np.mean([min(cv2.PSNR(output, expected), 99.0) for output, expected in zip(outputs, reference)])
+        results[name] = (frames_per_second, bytes_per_frame, psnr)
+        print(f"{name:>24}: {frames_per_second:7.1f} frames/s, {bytes_per_frame / 1024 ** 2:6.1f} MB allocated per frame, "
+              f"PSNR {psnr:5.1f} dB")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Motion blur videos. Without files, they are picked in a dialog.")
+    parser.add_argument('files', nargs='*', help="videos to blur; each is saved as <name>_smoothed.mp4")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--segments', type=int, default=1,
+                        help="split each video at keyframes into this many parts processed in parallel")
+    parser.add_argument('-o', '--output-dir', help="folder for the outputs (default: next to each input)")
+    parser.add_argument('--temporal', default='ema', choices=list(TEMPORAL_FILTERS),
+                        help="blur across frames: moving average, box average of a window, or shutter emulation")
+    parser.add_argument('--weight', type=float, default=0.2, help="weight of each new frame in the moving average")
+    parser.add_argument('--window', type=int, default=5, help="frames in the box average")
+    parser.add_argument('--shutter-angle', type=float, default=720, help="emulated shutter in degrees, 360 per frame")
+    parser.add_argument('--spatial', default='gaussian', choices=SPATIAL_FILTERS, help="blur within each frame")
+    parser.add_argument('--kernel', type=int, default=15, help="spatial blur kernel size in pixels")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="run the spatial blur at this fraction of the resolution and scale it back up")
+    parser.add_argument('--benchmark', metavar='VIDEO',
+                        help="compare frames/s, allocations and quality of the filters on a video instead")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+        return 0
+
+    file_paths = args.files
+    if not file_paths:
+        root = tk.Tk()
+        root.withdraw()
+
+        file_paths = filedialog.askopenfilenames(title="Select .mp4 files", filetypes=[("MP4 files", "*.mp4")])
 
-def main():
-    root = tk.Tk()
-    root.withdraw()
-    
-    file_paths = filedialog.askopenfilenames(title="Select .mp4 files", filetypes=[("MP4 files", "*.mp4")])
-    
     if not file_paths:
         print("No files selected.")
-        return
-    
-    for i, file_path in enumerate(file_paths):
-        output_path = f"output_{i}.mp4"
-        print(f"Processing {file_path}...")
-        apply_motion_blur(file_path, output_path)
+        return 1
+
+    print(f"Processing {len(file_paths)} videos...")
+    results = smooth_videos(file_paths, workers=min(args.workers, len(file_paths) * args.segments),
+                            segments=args.segments, output_dir=args.output_dir,
+                            temporal=args.temporal, spatial=args.spatial, kernel_size=args.kernel, scale=args.scale,
+                            weight=args.weight, window=args.window, shutter_angle=args.shutter_angle)
+    return 1 if any(isinstance(result, Exception) for result in results.values()) else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
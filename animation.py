@@ -0,0 +1,286 @@
+import argparse
+import os
+import sys
+from collections import deque
+from functools import partial
+import numpy as np
+import rawpy
+from PIL import Image, GifImagePlugin
+from frame_cache import FRAME_CACHE_DIR, FRAME_CACHE_LIMIT, FrameCache, cached_decode
+from palette import build_palette, dither_strength, palette_lut, quality_colors, quantize
+from raw_decode import create_executor, decode_raw
+
+# Frames decoded ahead of the writer per worker; only these are ever held in memory
+FRAMES_IN_FLIGHT_PER_WORKER = 2
+
+# Longest side of frames when exporting with optimization on
+OPTIMIZED_SIZE = 800
+
+OUTPUT_FORMATS = ('gif', 'webp')
+
+# Frames, spread across the sequence, whose pixels the GIF palette is built from
+PALETTE_SAMPLE_FRAMES = 16
+
+# Pixels sampled for the GIF palette in total
+PALETTE_SAMPLE_PIXELS = 250000
+
+
+def half_size_height(file_path):
+    """Height of a RAW file's half-size decode, upright, read from its header without decoding."""
+    with rawpy.imread(file_path) as raw:
+        sizes = raw.sizes
+    # 5 and 6 are the 90 degree rotations, which postprocess applies
+    return (sizes.width if sizes.flip in (5, 6) else sizes.height) // 2
+
+
+def prepare_frame(file_path, height=None, max_size=None, cache=None, size=None):
+    """Decode one frame for export and scale it to ``height`` and then to fit ``max_size``, as RGB uint8.
+
+    ``size`` forces the final (width, height), so every frame matches the first.
+    """
+    if file_path.lower().endswith('.dng'):
+        # A half-size decode is enough for optimized frames, and for a height only
+        # if the half-size frame is still that tall, so it's never upscaled
+        if height:
+            preview = min(height, max_size or height) <= half_size_height(file_path)
+        else:
+            preview = bool(max_size)
+        options = {'profile': 'preview' if preview else 'balanced'}
+        # Exporting the same frames again reads them back instead of decoding
+        frame = cached_decode(cache, file_path, options, decode_raw)
+        img = Image.fromarray(np.asarray(frame))
+    else:
+        img = Image.open(file_path)
+    img = img.convert('RGB')
+    if height:
+        width = int(img.size[0] * height / img.size[1])
+        img = img.resize((width, height), Image.LANCZOS)
+    if max_size:
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+    if size and img.size != tuple(size):
+        img = img.resize(tuple(size), Image.LANCZOS)
+    return np.asarray(img)
+
+
+def sample_pixels(file_path, count, **prepare_options):
+    """Prepare a frame and return its (width, height) with ``count`` of its pixels picked at random."""
+    frame = prepare_frame(file_path, **prepare_options)
+    pixels = frame.reshape(-1, 3)
+    picked = np.random.default_rng(0).choice(len(pixels), min(count, len(pixels)), replace=False)
+    return (frame.shape[1], frame.shape[0]), pixels[picked]
+
+
+def prepare_indexed(file_path, lut, dither=0.0, **prepare_options):
+    """Prepare a frame and map it to palette indices, so the quantizing runs on the workers too."""
+    return quantize(prepare_frame(file_path, **prepare_options), lut, dither)
+
+
+def global_palette(executor, file_paths, colors, **prepare_options):
+    """Build one palette from frames sampled across the sequence, returning it with the first frame's size."""
+    picks = np.unique(np.linspace(0, len(file_paths) - 1, min(PALETTE_SAMPLE_FRAMES, len(file_paths))).astype(int))
+    count = PALETTE_SAMPLE_PIXELS // len(picks)
+    samples = list(executor.map(partial(sample_pixels, count=count, **prepare_options),
+                                [file_paths[i] for i in picks]))
+    return build_palette(np.concatenate([pixels for _, pixels in samples]), colors), samples[0][0]
+
+
+def prepared_frames(executor, file_paths, window, function=prepare_frame, **options):
+    """Yield ``function`` of each file in order, running at most ``window`` ahead of the consumer on an executor."""
+    paths = iter(file_paths)
+    pending = deque()
+    for file_path in paths:
+        pending.append(executor.submit(function, file_path, **options))
+        if len(pending) >= window:
+            break
+    while pending:
+        frame = pending.popleft().result()
+        for file_path in paths:
+            pending.append(executor.submit(function, file_path, **options))
+            break
+        yield frame
+
+
+class GifWriter:
+    """Writes a GIF of palette index frames one at a time, so only the frame being written is held in memory.
+
+    Pillow's own writer keeps every frame until the end to merge duplicates,
+    so this writes the container itself and lets Pillow LZW-encode each frame.
+    Every frame shares the one global colour table.
+    """
+
+    def __init__(self, output_path, palette, fps=24, loop=0):
+        self.file = open(output_path, 'wb')
+        self.palette = np.asarray(palette, dtype=np.uint8).tobytes()
+        self.duration = 1000 / fps
+        self.loop = loop
+
+    def write(self, indices):
+        image = Image.fromarray(indices)
+        image.putpalette(self.palette)
+        if self.file.tell() == 0:
+            header, _ = GifImagePlugin.getheader(image, info={'loop': self.loop, 'duration': self.duration})
+            self.file.write(b''.join(header))
+        for data in GifImagePlugin.getdata(image, duration=self.duration):
+            self.file.write(data)
+
+    def close(self):
+        if not self.file.closed:
+            # Trailer
+            self.file.write(b';')
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FrameStream(Image.Image):
+    """Frames pulled from an iterator one at a time, for Pillow to save as if they were a multi-frame image.
+
+    Pillow's WebP writer seeks through each frame in turn and encodes it
+    straight away, so only the current frame is ever decoded. A list of
+    ``append_images`` would hold every frame at once.
+    """
+
+    def __init__(self, frames, n_frames):
+        super().__init__()
+        self.frames = frames
+        self.n_frames = n_frames
+        self.is_animated = n_frames > 1
+        self.frame = -1
+
+    def seek(self, frame):
+        if frame < self.frame:
+            raise ValueError("Frames can only be read forward")
+        while self.frame < frame:
+            image = Image.fromarray(next(self.frames))
+            # A real image underneath, swapped in the way Pillow's own multi-frame
+            # formats do in seek(), so the writer can load, convert or tobytes() it.
+            # mode and size read _mode and _size from Pillow 10.1 on.
+            self.im = image.im
+            self._mode = image.mode
+            self._size = image.size
+            self.frame += 1
+
+    def tell(self):
+        return self.frame
+
+
+def write_webp(output_path, frames, count, fps=24, loop=0, quality=85):
+    """Encode ``count`` frames from an iterator into an animated WebP."""
+    first = Image.fromarray(next(frames))
+    first.save(output_path, format='WEBP', save_all=True, append_images=[FrameStream(frames, count - 1)],
+               duration=1000 / fps, loop=loop, quality=quality)
+
+
+def export_animation(file_paths, output_path, output_format='gif', fps=24, loop=0, quality=85, height=None,
+                     optimize=True, workers=None, cache=None, progress=None, cancel=None, dither=False):
+    """Stream frames from a process pool into a GIF or WebP, returning False if cancelled.
+
+    GIFs share one palette built from a sample of the frames, with more
+    colours the higher the ``quality``, and can be ordered dithered. The
+    workers map frames to it, so only palette indices come back.
+
+    ``progress`` is called with the frames done so far and the total as each
+    one goes to the writer. Setting the ``cancel`` event stops the export and
+    deletes the partial file.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    total = len(file_paths)
+    workers = workers or os.cpu_count() or 1
+    window = workers * FRAMES_IN_FLIGHT_PER_WORKER
+    prepare_options = {'height': height, 'max_size': OPTIMIZED_SIZE if optimize else None, 'cache': cache}
+    executor = create_executor(workers)
+    try:
+        if output_format == 'gif':
+            colors = quality_colors(quality)
+            palette, size = global_palette(executor, file_paths, colors, **prepare_options)
+            frames = prepared_frames(executor, file_paths, window, prepare_indexed, lut=palette_lut(palette),
+                                     dither=dither_strength(colors) if dither else 0.0, size=size, **prepare_options)
+        else:
+            frames = prepared_frames(executor, file_paths, window, **prepare_options)
+            palette = None
+        completed = write_animation(frames, output_path, output_format, total, palette, fps, loop, quality,
+                                    progress, cancel)
+    finally:
+        # Cancelled exports drop the frames that haven't started
+        executor.shutdown(wait=True, cancel_futures=True)
+    return completed
+
+
+def write_animation(frames, output_path, output_format, total, palette, fps, loop, quality, progress, cancel):
+    """Write prepared frames as they arrive, deleting the file if cancelled or failed."""
+
+    def counted():
+        size = None
+        for done, frame in enumerate(frames, 1):
+            if cancel is not None and cancel.is_set():
+                return
+            # WebP needs every frame at the first one's size; GIF frames come sized from the workers
+            if size is None:
+                size = frame.shape[:2]
+            elif frame.shape[:2] != size:
+                frame = np.asarray(Image.fromarray(frame).resize((size[1], size[0]), Image.LANCZOS))
+            if progress:
+                progress(done, total)
+            yield frame
+
+    stream = counted()
+    try:
+        if output_format == 'gif':
+            with GifWriter(output_path, palette, fps, loop) as writer:
+                for frame in stream:
+                    writer.write(frame)
+        else:
+            write_webp(output_path, stream, total, fps, loop, quality)
+    except StopIteration:
+        # WebP ran out of frames because the export was cancelled
+        pass
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        frames.close()
+    if cancel is not None and cancel.is_set():
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make a GIF or WebP from image or DNG files without the UI.")
+    parser.add_argument('files', nargs='+', help="frames in order")
+    parser.add_argument('-o', '--output', required=True, help="output .gif or .webp")
+    parser.add_argument('--fps', type=float, default=24, help="frames per second")
+    parser.add_argument('--loop', type=int, default=0, help="number of loops (0 for infinite)")
+    parser.add_argument('--quality', type=int, default=85,
+                        help="1-100; WebP compression quality, or the number of GIF palette colours")
+    parser.add_argument('--dither', action='store_true', help="ordered dither GIF frames to the palette")
+    parser.add_argument('--height', type=int, help="scale frames to this height")
+    parser.add_argument('--no-optimize', action='store_true',
+                        help=f"keep the full size instead of fitting frames in {OPTIMIZED_SIZE}px")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="decode worker processes")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep decoded DNG frames on disk so exporting the same files again skips decoding")
+    parser.add_argument('--cache-dir', default=FRAME_CACHE_DIR, help="decoded frame cache folder")
+    parser.add_argument('--cache-limit', type=float, default=FRAME_CACHE_LIMIT / 1024 ** 3,
+                        help="decoded frame cache size in GB; the least recently used frames go first")
+    args = parser.parse_args(argv)
+
+    output_format = os.path.splitext(args.output)[1].lower().lstrip('.')
+    cache = FrameCache(args.cache_dir, int(args.cache_limit * 1024 ** 3)) if args.cache else None
+    export_animation(args.files, args.output, output_format, args.fps, args.loop, args.quality, args.height,
+                     not args.no_optimize, args.workers, cache,
+                     progress=lambda done, total: print(f"\r{done}/{total} frames", end='', flush=True),
+                     dither=args.dither)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+# Everything the tools cache between runs lives here
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "SeanKD_PhotoTools")
+FRAME_CACHE_DIR = os.path.join(CACHE_DIR, "frames")
+
+# Default size cap of the decoded frame cache
+FRAME_CACHE_LIMIT = 20 * 1024 ** 3
+
+
+class FrameCache:
+    """Decoded frames on disk as memory-mappable .npy files, evicting the least recently used.
+
+    A frame is keyed by its source file's path, mtime and size and by the
+    options it was decoded with, so editing a file or changing a decode
+    setting never returns a stale frame. The cache holds no open files, so it
+    can be pickled to the decode workers, and several processes can share one
+    folder: files are written to a temporary name and renamed into place.
+    """
+
+    def __init__(self, directory=FRAME_CACHE_DIR, max_bytes=FRAME_CACHE_LIMIT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, file_path, options):
+        """Cache file for a source file decoded with ``options``, or None if the source is gone."""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        key = json.dumps([os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, options],
+                         sort_keys=True, default=str)
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, file_path, options):
+        """The cached frame as a read-only memory map, or None on a miss."""
+        cache_path = self.path(file_path, options)
+        if cache_path is None:
+            return None
+        try:
+            frame = np.load(cache_path, mmap_mode='r')
+            # The modification time doubles as the last use for eviction
+            os.utime(cache_path)
+        except (OSError, ValueError):
+            return None
+        return frame
+
+    def put(self, file_path, options, frame):
+        """Store a decoded frame, then trim the cache back under its size cap."""
+        cache_path = self.path(file_path, options)
+        if cache_path is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, frame)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # Full disk, or on Windows another process has the frame mapped; just don't cache it
+            os.remove(temp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used frames until the cache fits in ``max_bytes``."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process got there first
+                pass
+            total -= size
+
+
+def cached_decode(cache, file_path, options, decode, timings=None):
+    """``decode(file_path, **options)`` read from or added to a FrameCache, or straight through if ``cache`` is None.
+
+    With a ``timings`` dict the seconds taken are stored under 'cache_read' on
+    a hit, or 'decode' and 'cache_write' on a miss.
+    """
+    start = time.perf_counter()
+    frame = cache.get(file_path, options) if cache is not None else None
+    if frame is not None:
+        if timings is not None:
+            timings['cache_read'] = time.perf_counter() - start
+        return frame
+    frame = decode(file_path, **options)
+    if timings is not None:
+        timings['decode'] = time.perf_counter() - start
+    if cache is not None:
+        start = time.perf_counter()
+        cache.put(file_path, options, frame)
+        if timings is not None:
+            timings['cache_write'] = time.perf_counter() - start
+    return frame
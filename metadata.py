@@ -0,0 +1,77 @@
+import subprocess
+import threading
+
+# exiftool on the PATH; DNGstacker ships its own exiftool.exe next to the scripts
+EXIFTOOL = 'exiftool'
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifTool:
+    """One long-lived ``exiftool -stay_open`` process that runs commands sent over stdin.
+
+    Starting exiftool costs far more than copying one file's tags, so a batch
+    keeps a single process for every file. It can be shared between threads.
+    """
+
+    def __init__(self, executable=EXIFTOOL):
+        self.process = subprocess.Popen(
+            [executable, '-stay_open', 'True', '-@', '-', '-common_args', '-charset', 'filename=utf8'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def execute(self, *args):
+        """Run one exiftool command, returning its (stdout, stderr) text."""
+        with self.lock:
+            self.commands += 1
+            # exiftool prints the marker on stdout when the command is done, and
+            # -echo4 prints it on stderr once everything else has been written there
+            marker = f"{{ready{self.commands}}}"
+            lines = [*args, '-echo4', marker, f'-execute{self.commands}']
+            try:
+                self.process.stdin.write(''.join(f"{line}\n" for line in lines).encode('utf-8'))
+                self.process.stdin.flush()
+            except OSError as e:
+                raise ExifToolError(f"exiftool has stopped: {e}") from e
+            return read_until(self.process.stdout, marker), read_until(self.process.stderr, marker)
+
+    def copy_metadata(self, source_path, target_path):
+        """Copy all tags from one file to another in place, raising ExifToolError if it wasn't updated."""
+        output, errors = self.execute('-TagsFromFile', source_path, '-all:all', '-overwrite_original', '-m', target_path)
+        if '1 image files updated' not in output:
+            raise ExifToolError(errors.strip() or output.strip() or "exiftool didn't update the file")
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_until(stream, marker):
+    """Read lines from an exiftool pipe up to a marker line, returning the text before it."""
+    lines = []
+    while True:
+        line = stream.readline()
+        if not line:
+            raise ExifToolError("exiftool exited unexpectedly")
+        line = line.decode('utf-8', errors='replace')
+        if line.rstrip('\r\n') == marker:
+            return ''.join(lines)
+        lines.append(line)
@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+import psutil
+
+# Seconds between samples sent to the log and the callback
+METRICS_INTERVAL = 1.0
+
+
+class StackMetrics:
+    """Per-stage timings and throughput of a stack, sampled to a JSON-lines log and/or a callback.
+
+    Stage times are summed in seconds under their stage name ("decode",
+    "queue_wait", "accumulate", "save", ...). Every file also gets a "frame"
+    record in the log with its own stage times. At most every ``interval``
+    seconds a "sample" record with the totals, frames/s and resident memory of
+    this process and its decode workers is logged and passed to ``callback``.
+    """
+
+    def __init__(self, log_path=None, callback=None, interval=METRICS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.log = open(log_path, 'a') if log_path else None
+        self.process = psutil.Process()
+        self.stages = {}
+        self.frames = 0
+        self.peak_rss = 0
+        self.start_time = time.perf_counter()
+        self.last_sample = None
+
+    def start(self, **info):
+        """Begin timing a stack, logging ``info`` (method, file count, ...) with it."""
+        self.stages = {}
+        self.frames = 0
+        self.start_time = time.perf_counter()
+        self.last_sample = None
+        self.write(dict(info, event='start'))
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, stage):
+        """Time the body of a with block as ``stage``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def frame(self, file_path, timings):
+        """Record one stacked file and the seconds each stage took for it."""
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+        self.frames += 1
+        if self.log is not None:
+            self.write({'event': 'frame', 'file': file_path,
+                        **{stage: round(seconds, 6) for stage, seconds in timings.items()}})
+        self.sample()
+
+    def rss(self):
+        """Resident memory of this process and its children, in bytes."""
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                # Workers can exit between listing and reading them
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def sample(self, force=False):
+        """Log and report the running totals if ``interval`` has passed since the last sample."""
+        now = time.perf_counter()
+        if not force and self.last_sample is not None and now - self.last_sample < self.interval:
+            return None
+        self.last_sample = now
+        elapsed = now - self.start_time
+        snapshot = {
+            'event': 'sample',
+            'elapsed': round(elapsed, 3),
+            'frames': self.frames,
+            'fps': round(self.frames / elapsed, 3) if elapsed > 0 else 0.0,
+            'stages': {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+            'rss': self.rss(),
+            'peak_rss': self.peak_rss,
+        }
+        self.write(snapshot)
+        if self.callback is not None:
+            self.callback(snapshot)
+        return snapshot
+
+    def finish(self, **info):
+        """Log the final totals of a stack and return them."""
+        summary = self.sample(force=True)
+        self.write(dict(info, event='finish'))
+        return summary
+
+    def write(self, record):
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def format_metrics(snapshot):
+    """Short human-readable summary of a metrics sample."""
+    stages = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in snapshot['stages'].items())
+    return (f"{snapshot['frames']} frames at {snapshot['fps']:.2f} frames/s\n"
+            f"{stages or 'No stages timed yet'}\n"
+            f"Memory: {snapshot['rss'] / 1024 ** 2:.0f} MB (peak {snapshot['peak_rss'] / 1024 ** 2:.0f} MB), "
+            f"{os.cpu_count()} threads")
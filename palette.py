@@ -0,0 +1,102 @@
+import numpy as np
+
+# Bits per channel of the colour lookup table: 64^3 cells, 256 KB
+LUT_BITS = 6
+
+# k-means passes refining the median cut palette on the sampled pixels
+KMEANS_ITERATIONS = 3
+
+# Colours compared at once when finding nearest palette entries, bounding the distance matrix
+NEAREST_CHUNK = 16384
+
+# 8x8 Bayer matrix as thresholds in [-0.5, 0.5)
+BAYER_8X8 = (np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.float32) + 0.5) / 64 - 0.5
+
+
+def quality_colors(quality):
+    """Palette size for a 1-100 quality setting."""
+    return int(np.clip(round(quality / 100 * 256), 2, 256))
+
+
+def median_cut(pixels, colors):
+    """Split an (N, 3) array of colours into up to ``colors`` boxes, returning the mean of each."""
+    boxes = [pixels]
+    ranges = [np.ptp(pixels, axis=0)]
+    while len(boxes) < colors:
+        # Split the box with the widest channel, weighted by how many pixels it holds
+        scores = [r.max() * len(box) for r, box in zip(ranges, boxes)]
+        widest = int(np.argmax(scores))
+        if scores[widest] == 0:
+            break
+        box = boxes.pop(widest)
+        channel = int(np.argmax(ranges.pop(widest)))
+        order = np.argsort(box[:, channel], kind='stable')
+        half = len(box) // 2
+        for part in (box[order[:half]], box[order[half:]]):
+            boxes.append(part)
+            ranges.append(np.ptp(part, axis=0))
+    return np.array([box.mean(axis=0) for box in boxes], dtype=np.float32)
+
+
+def nearest(colors, palette):
+    """Index of the nearest palette entry for each of an (N, 3) array of colours."""
+    colors = np.asarray(colors, dtype=np.float32)
+    palette = np.asarray(palette, dtype=np.float32)
+    palette_norms = (palette ** 2).sum(axis=1)
+    indices = np.empty(len(colors), dtype=np.uint8)
+    for start in range(0, len(colors), NEAREST_CHUNK):
+        chunk = colors[start:start + NEAREST_CHUNK]
+        # |c - p|^2 without the |c|^2 term, which is the same for every entry
+        distances = palette_norms - 2 * chunk @ palette.T
+        indices[start:start + NEAREST_CHUNK] = distances.argmin(axis=1)
+    return indices
+
+
+def build_palette(pixels, colors=256, iterations=KMEANS_ITERATIONS):
+    """One palette for a sample of (N, 3) uint8 pixels: median cut, refined by k-means. Returns uint8 (colors, 3)."""
+    pixels = np.asarray(pixels, dtype=np.float32).reshape(-1, 3)
+    palette = median_cut(pixels, colors)
+    for _ in range(iterations):
+        labels = nearest(pixels, palette)
+        counts = np.bincount(labels, minlength=len(palette))
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=len(palette)) for c in range(3)], axis=1)
+        used = counts > 0
+        # Entries nothing maps to keep their place rather than collapsing to black
+        palette[used] = sums[used] / counts[used, None]
+    return np.clip(np.rint(palette), 0, 255).astype(np.uint8)
+
+
+def palette_lut(palette):
+    """Nearest palette index for every cell of a LUT_BITS-per-channel colour cube, looked up by quantize()."""
+    levels = 1 << LUT_BITS
+    step = 256 // levels
+    centres = np.arange(levels, dtype=np.float32) * step + (step - 1) / 2
+    grid = np.stack(np.meshgrid(centres, centres, centres, indexing='ij'), axis=-1).reshape(-1, 3)
+    return nearest(grid, palette)
+
+
+def dither_strength(colors):
+    """Ordered dither amplitude for a palette size: about the spacing of its colours."""
+    return 255 / colors ** (1 / 3)
+
+
+def quantize(frame, lut, dither=0.0):
+    """Map an RGB uint8 frame to palette indices through a LUT, with ordered dithering of ``dither`` levels."""
+    if dither:
+        height, width = frame.shape[:2]
+        thresholds = np.tile(BAYER_8X8, (height // 8 + 1, width // 8 + 1))[:height, :width, None]
+        frame = np.clip(frame + thresholds * dither, 0, 255).astype(np.uint8)
+    shift = 8 - LUT_BITS
+    cells = (frame[..., 0] >> shift).astype(np.int32) << (2 * LUT_BITS)
+    cells |= (frame[..., 1] >> shift).astype(np.int32) << LUT_BITS
+    cells |= frame[..., 2] >> shift
+    return lut[cells]
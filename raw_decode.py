@@ -0,0 +1,87 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import rawpy
+
+# Named LibRaw settings shared by the stacker, the desqueezer and the GIF maker.
+# Every profile uses the camera's white balance.
+DECODE_PROFILES = {
+    # Half size merges each 2x2 Bayer block, so there is no real demosaic to pay for
+    'preview': {'half_size': True, 'demosaic_algorithm': 'LINEAR', 'output_bps': 8},
+    'balanced': {'half_size': False, 'demosaic_algorithm': 'AHD', 'output_bps': 8},
+    'full': {'half_size': False, 'demosaic_algorithm': 'AHD', 'output_bps': 16},
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+
+def decode_options(profile=DEFAULT_PROFILE, **overrides):
+    """rawpy postprocess arguments for a named profile, with any settings overridden."""
+    if profile not in DECODE_PROFILES:
+        raise ValueError(f"Unknown decode profile: {profile}")
+    options = dict(DECODE_PROFILES[profile], use_camera_wb=True)
+    options.update(overrides)
+    if isinstance(options['demosaic_algorithm'], str):
+        options['demosaic_algorithm'] = rawpy.DemosaicAlgorithm[options['demosaic_algorithm']]
+    return options
+
+
+def postprocess(raw, profile=DEFAULT_PROFILE, **overrides):
+    """Develop an open rawpy image with a decode profile."""
+    return raw.postprocess(**decode_options(profile, **overrides))
+
+
+def decode_raw(file_path, profile=DEFAULT_PROFILE, **overrides):
+    """Decode a RAW file to an RGB array with a decode profile."""
+    with rawpy.imread(file_path) as raw:
+        return postprocess(raw, profile, **overrides)
+
+
+def create_executor(workers, initializer=None):
+    """Process pool for decoding. Workers are spawned, as LibRaw's OpenMP can deadlock after fork."""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=initializer)
+
+
+def decoded_pixels(file_path, profile):
+    """Decode a file and return only its pixel count, so the benchmark doesn't time the transfer back."""
+    frame = decode_raw(file_path, profile)
+    return frame.shape[0] * frame.shape[1]
+
+
+def benchmark_profiles(file_paths, profiles=None, workers=None):
+    """Decode files with each profile on a process pool, returning {profile: (frames/s, megapixels/s)}."""
+    workers = workers or os.cpu_count() or 1
+    results = {}
+    for profile in profiles or DECODE_PROFILES:
+        decode_options(profile)
+        with create_executor(workers) as executor:
+            # Start the workers before the clock does
+            for future in [executor.submit(os.getpid) for _ in range(workers)]:
+                future.result()
+            start = time.perf_counter()
+            pixels = sum(executor.map(decoded_pixels, file_paths, [profile] * len(file_paths)))
+            elapsed = time.perf_counter() - start
+        results[profile] = (len(file_paths) / elapsed, pixels / 1e6 / elapsed)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the RAW decode profiles on some files.")
+    parser.add_argument('files', nargs='+', help="RAW files to decode")
+    parser.add_argument('-p', '--profile', action='append', choices=list(DECODE_PROFILES),
+                        help="profile to benchmark, can be repeated (default: all)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="decode worker processes")
+    args = parser.parse_args(argv)
+
+    for profile, (frames_per_second, megapixels_per_second) in benchmark_profiles(
+            args.files, args.profile, args.workers).items():
+        print(f"{profile:>10}: {frames_per_second:7.2f} frames/s, {megapixels_per_second:8.1f} MP/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+
+# Longest side of the luminance images that transforms are estimated on
+REGISTRATION_SIZE = 1024
+
+# ORB features matched per frame for homographies
+HOMOGRAPHY_FEATURES = 2000
+
+# Matches needed before a homography is trusted over a plain translation
+MIN_HOMOGRAPHY_MATCHES = 12
+
+REGISTRATION_MODES = ('translation', 'homography')
+
+
+def luminance(frame, shape=None):
+    """Downscaled float32 luminance of a frame, resized to ``shape`` if given."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY) if frame.ndim == 3 else frame
+    if shape is None:
+        scale = min(1.0, REGISTRATION_SIZE / max(gray.shape[:2]))
+        shape = (max(1, round(gray.shape[0] * scale)), max(1, round(gray.shape[1] * scale)))
+    if gray.shape[:2] != tuple(shape):
+        gray = cv2.resize(gray, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return gray.astype(np.float32)
+
+
+def estimate_translation(reference, image):
+    """3x3 transform moving ``image`` onto ``reference``, by phase correlation."""
+    window = cv2.createHanningWindow((reference.shape[1], reference.shape[0]), cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(reference, image, window)
+    return np.array([[1, 0, -dx], [0, 1, -dy], [0, 0, 1]], dtype=np.float64)
+
+
+def to_uint8(image):
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+
+def estimate_homography(reference, image):
+    """3x3 homography moving ``image`` onto ``reference`` from matched ORB features.
+
+    Falls back to a translation when there are too few matches to fit one.
+    """
+    orb = cv2.ORB_create(HOMOGRAPHY_FEATURES)
+    reference_points, reference_descriptors = orb.detectAndCompute(to_uint8(reference), None)
+    image_points, image_descriptors = orb.detectAndCompute(to_uint8(image), None)
+    if reference_descriptors is not None and image_descriptors is not None:
+        matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(image_descriptors, reference_descriptors)
+        if len(matches) >= MIN_HOMOGRAPHY_MATCHES:
+            source = np.float32([image_points[m.queryIdx].pt for m in matches])
+            target = np.float32([reference_points[m.trainIdx].pt for m in matches])
+            homography, _ = cv2.findHomography(source, target, cv2.RANSAC, 3.0)
+            if homography is not None:
+                return homography
+    return estimate_translation(reference, image)
+
+
+def register_frame(frame, reference, mode='translation'):
+    """Warp a frame onto the reference luminance, returning the frame and its full-size transform."""
+    if mode not in REGISTRATION_MODES:
+        raise ValueError(f"Unknown registration mode: {mode}")
+    image = luminance(frame, reference.shape)
+    if mode == 'translation':
+        transform = estimate_translation(reference, image)
+    else:
+        transform = estimate_homography(reference, image)
+
+    # Bring the transform from the luminance scale up to the full frame
+    height, width = frame.shape[:2]
+    scale = np.diag([width / reference.shape[1], height / reference.shape[0], 1.0])
+    transform = scale @ transform @ np.linalg.inv(scale)
+
+    # Replicated borders keep the edges from being averaged with black
+    if mode == 'translation':
+        warped = cv2.warpAffine(frame, transform[:2], (width, height), flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+    else:
+        warped = cv2.warpPerspective(frame, transform, (width, height), flags=cv2.INTER_LINEAR,
+                                     borderMode=cv2.BORDER_REPLICATE)
+    return warped, transform
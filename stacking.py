@@ -0,0 +1,924 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fractions import Fraction
+import numpy as np
+import rawpy
+from PIL import Image, ExifTags
+from frame_cache import CACHE_DIR, FRAME_CACHE_DIR, FRAME_CACHE_LIMIT, FrameCache, cached_decode
+from metrics import METRICS_INTERVAL, StackMetrics
+from raw_decode import DECODE_PROFILES, DEFAULT_PROFILE, create_executor, postprocess
+from registration import REGISTRATION_MODES, luminance, register_frame
+from thumbnails import raw_preview
+from tiff_writer import write_tiff
+
+# Default ceiling for the temporaries of a single sigma clipping band
+DEFAULT_MEMORY_LIMIT = 2 * 1024 ** 3
+
+# Decoded frames allowed in flight per decode worker before decoding pauses
+FRAMES_IN_FLIGHT_PER_WORKER = 2
+
+# Number of frames between preview updates
+PREVIEW_INTERVAL = 100
+
+# Output sample types by bit depth. Stacks are kept on the 0-255 scale of 8-bit
+# decodes; 16-bit output spans the full integer range and float output 0-1
+OUTPUT_DTYPES = {8: np.uint8, 16: np.uint16, 32: np.float32}
+
+# Image rows written per TIFF strip, so saving only holds a few rows at a time
+OUTPUT_STRIP_ROWS = 64
+
+# Long edge of the final preview, which is sampled from the strips as they are saved
+FINAL_PREVIEW_SIZE = 1200
+
+# Long edge of quick look frames; the UI preview itself is 600px
+QUICK_LOOK_SIZE = 1024
+
+# Exposure times already read, keyed by path and checked against mtime and size
+EXPOSURE_CACHE_PATH = os.path.join(CACHE_DIR, "exposure_times.json")
+
+# Threads reading exposure times; the scan is I/O bound, especially on network shares
+EXPOSURE_SCAN_WORKERS = 16
+
+# TIFF tags for the exposure time and the EXIF sub-IFD that usually holds it
+EXPOSURE_TIME_TAG = 33434
+EXIF_IFD_TAG = 34665
+
+# Files in a checkpoint folder, and the default number of frames between checkpoints
+CHECKPOINT_STATE = "state.json"
+CHECKPOINT_SPILL = "frames.spill"
+CHECKPOINT_INTERVAL = 25
+
+# Rough peak bytes per stacked sample while clipping a band: the float32 stack,
+# the deviation and clipped copies, nanmean's working copy and the boolean masks
+BAND_BYTES_PER_SAMPLE = 20
+
+
+def get_exposure_time(file_path):
+    """Get the exposure time from EXIF data as a Fraction."""
+    with Image.open(file_path) as image:
+        img_exif = image.getexif()
+        for (k, v) in img_exif.items():
+            if ExifTags.TAGS.get(k) == 'ExposureTime':
+                exposure_time = v
+                if isinstance(exposure_time, tuple) and len(exposure_time) == 2:
+                    # Exposure time is a fraction
+                    return Fraction(exposure_time[0], exposure_time[1])
+                else:
+                    # Exposure time is a float
+                    return Fraction(exposure_time)
+    return Fraction(0)
+
+
+def read_ifd(f, endian, offset):
+    """Read the entries of one TIFF IFD as {tag: (type, count, raw value bytes)}."""
+    f.seek(offset)
+    count_bytes = f.read(2)
+    if len(count_bytes) < 2:
+        return {}
+    (count,) = struct.unpack(endian + 'H', count_bytes)
+    data = f.read(count * 12)
+    entries = {}
+    for start in range(0, len(data) - 11, 12):
+        tag, field_type, field_count = struct.unpack(endian + 'HHI', data[start:start + 8])
+        entries[tag] = (field_type, field_count, data[start + 8:start + 12])
+    return entries
+
+
+def read_exposure_time(file_path):
+    """Read ExposureTime straight from the TIFF/DNG header as a Fraction.
+
+    Only IFD0 and the EXIF sub-IFD are read, never the image data. Returns None
+    when the file isn't a classic TIFF or the tag isn't a readable RATIONAL or
+    SRATIONAL, so the caller can fall back to PIL.
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(8)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            return None
+        endian = '<' if header[:2] == b'II' else '>'
+        magic, ifd_offset = struct.unpack(endian + 'HI', header[2:])
+        if magic != 42:
+            return None
+        # ExposureTime is in IFD0 for most DNGs, otherwise in the EXIF sub-IFD
+        for _ in range(2):
+            entries = read_ifd(f, endian, ifd_offset)
+            if EXPOSURE_TIME_TAG in entries:
+                field_type, _, value = entries[EXPOSURE_TIME_TAG]
+                # RATIONAL or SRATIONAL are always stored at an offset; PIL handles anything else
+                if field_type not in (5, 10):
+                    return None
+                f.seek(struct.unpack(endian + 'I', value)[0])
+                data = f.read(8)
+                if len(data) < 8:
+                    return None
+                numerator, denominator = struct.unpack(endian + ('ii' if field_type == 10 else 'II'), data)
+                return Fraction(numerator, denominator) if denominator else Fraction(0)
+            if EXIF_IFD_TAG not in entries:
+                break
+            ifd_offset = struct.unpack(endian + 'I', entries[EXIF_IFD_TAG][2])[0]
+    return Fraction(0)
+
+
+def load_exposure_cache(cache_path):
+    """Load the exposure time cache, or an empty one if it is missing or unreadable."""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json_atomic(path, data):
+    """Write JSON through a temporary file, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def save_exposure_cache(cache, cache_path):
+    """Write the exposure time cache atomically."""
+    write_json_atomic(cache_path, cache)
+
+
+def scan_exposure_times(file_paths, cache_path=EXPOSURE_CACHE_PATH, workers=EXPOSURE_SCAN_WORKERS):
+    """Exposure times of many files, read concurrently and cached by path, mtime and size.
+
+    Pass ``cache_path=None`` to skip the cache.
+    """
+    cache = load_exposure_cache(cache_path) if cache_path else {}
+    updates = {}
+
+    def exposure_time(file_path):
+        key = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cached = cache.get(key)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return Fraction(cached[2])
+        exposure = read_exposure_time(file_path)
+        if exposure is None:
+            exposure = get_exposure_time(file_path)
+        updates[key] = [stat.st_mtime_ns, stat.st_size, str(exposure)]
+        return exposure
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exposure_times = list(executor.map(exposure_time, file_paths))
+    if cache_path and updates:
+        cache.update(updates)
+        save_exposure_cache(cache, cache_path)
+    return exposure_times
+
+
+def default_output_path(file_paths, stacking_method, total_exposure_time):
+    """Output path next to the first file, named after the method and total exposure."""
+    save_dir = os.path.dirname(file_paths[0])
+    first_file_name = os.path.splitext(os.path.basename(file_paths[0]))[0]
+    save_filename = f"{first_file_name}_{stacking_method}_{float(total_exposure_time):.2f}s.tiff"
+    return os.path.join(save_dir, save_filename)
+
+
+def convert_rows(rows, bit_depth):
+    """Convert a block of stacked rows on the 0-255 scale to the output sample type."""
+    if bit_depth == 8:
+        return np.clip(rows, 0, 255).astype(np.uint8)
+    if bit_depth == 16:
+        return np.clip(np.rint(rows * 257), 0, 65535).astype(np.uint16)
+    return (rows / 255).astype(np.float32)
+
+
+def save_stack(strips, shape, save_path, total_exposure_time, bit_depth=8):
+    """Save stacked rows as a TIFF carrying the total exposure time, one strip at a time."""
+    if bit_depth not in OUTPUT_DTYPES:
+        raise ValueError(f"Unsupported output bit depth: {bit_depth}")
+    converted = (convert_rows(rows, bit_depth) for rows in strips)
+    write_tiff(save_path, shape, OUTPUT_DTYPES[bit_depth], converted, OUTPUT_STRIP_ROWS, total_exposure_time)
+
+
+def image_strips(image, rows, scale=1):
+    """Blocks of ``rows`` rows of an in-memory image as float32, multiplied by ``scale``."""
+    for start in range(0, image.shape[0], rows):
+        strip = image[start:start + rows].astype(np.float32)
+        strip *= scale
+        yield strip
+
+
+def sample_strips(strips, metrics):
+    """Pass strips through, sampling the metrics as each one is produced."""
+    for strip in strips:
+        yield strip
+        metrics.sample()
+
+
+def tap_preview(strips, shape, previews, preview_size=FINAL_PREVIEW_SIZE):
+    """Pass strips through, keeping every n-th row and column of each in ``previews``."""
+    step = max(1, -(-max(shape[:2]) // preview_size))
+    start = 0
+    for rows in strips:
+        previews.append(rows[(-start) % step::step, ::step].copy())
+        start += rows.shape[0]
+        yield rows
+
+
+def create_spill_file(shape, dtype, spill_dir=None):
+    """Memory-mapped temporary array and the path of the file backing it."""
+    fd, path = tempfile.mkstemp(prefix='dngstack-', suffix='.spill', dir=spill_dir)
+    os.close(fd)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=shape), path
+
+
+def open_spill_file(path, shape, dtype):
+    """Memory-map a persistent spill file, creating it or growing it to ``shape``."""
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, 'ab') as f:
+        if f.tell() < size:
+            f.truncate(size)
+    return np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+
+
+def load_checkpoint_state(directory):
+    """State saved in a checkpoint folder, or None if nothing was saved yet."""
+    try:
+        with open(os.path.join(directory, CHECKPOINT_STATE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def decode_frame(file_path, quick_look=False, bayer=False, profile=DEFAULT_PROFILE):
+    """Decode a RAW file to an RGB array with a decode profile. Runs in the decode worker processes.
+
+    With ``bayer`` the undemosaiced single-channel sensor data is returned instead.
+    """
+    with rawpy.imread(file_path) as raw:
+        if bayer:
+            return raw.raw_image_visible.copy()
+        if quick_look:
+            return decode_quick_look(raw)
+        frame = postprocess(raw, profile)
+    if frame.dtype == np.uint16:
+        # Stacks work on the 0-255 scale; 16-bit profiles keep their precision as floats
+        frame = np.multiply(frame, 255 / 65535, dtype=np.float32)
+    return frame
+
+
+def decode_timed(file_path, register=None, reference=None, cache=None, **decode_options):
+    """Decode a file in a worker, returning the frame and the seconds each step took.
+
+    With a FrameCache the decoded frame is read from or added to the
+    ``cache``. With ``register`` set the frame is also warped onto the
+    ``reference`` luminance.
+    """
+    timings = {}
+    frame = cached_decode(cache, file_path, decode_options, decode_frame, timings)
+    if register:
+        start = time.perf_counter()
+        frame, _ = register_frame(frame, reference, register)
+        timings['register'] = time.perf_counter() - start
+    return frame, timings
+
+
+def decode_reference(file_path, quick_look=False, profile=DEFAULT_PROFILE):
+    """Downscaled luminance of the frame the others are registered to."""
+    return luminance(decode_frame(file_path, quick_look=quick_look, profile=profile))
+
+
+def decode_quick_look(raw):
+    """Small RGB frame from the embedded preview, falling back to a half-size decode.
+
+    Both come out turned the way postprocess turns the full frames, so a stack
+    can mix them.
+    """
+    img = raw_preview(raw, QUICK_LOOK_SIZE)
+    if img is None or max(img.size) < QUICK_LOOK_SIZE:
+        img = Image.fromarray(postprocess(raw, 'preview'))
+    img = img.convert('RGB')
+    img.thumbnail((QUICK_LOOK_SIZE, QUICK_LOOK_SIZE))
+    return np.asarray(img)
+
+
+def demosaic_bayer_stack(reference_path, bayer_image, output_bps=8, profile=DEFAULT_PROFILE):
+    """Demosaic a stacked Bayer image with the LibRaw pipeline of one of its source files."""
+    with rawpy.imread(reference_path) as raw:
+        # raw_image_visible is a view of LibRaw's own buffer, so postprocess picks up the stack
+        visible = raw.raw_image_visible
+        np.copyto(visible, np.clip(np.rint(bayer_image), 0, np.iinfo(visible.dtype).max), casting='unsafe')
+        return postprocess(raw, profile, output_bps=output_bps)
+
+
+def bayer_preview(bayer_image, white_level):
+    """Grayscale 8-bit view of a stacked Bayer image for the live preview."""
+    return np.clip(bayer_image * (255 / white_level), 0, 255)
+
+
+def decode_frames(executor, file_paths, slots, **decode_options):
+    """Decode files on an executor, yielding (index, frame, timings) as each one finishes.
+
+    A slot of the ``slots`` semaphore is taken before each decode is submitted
+    and must be released by the consumer once it is done with the frame, so at
+    most as many frames as the semaphore allows are decoding or queued at once.
+    """
+    remaining = enumerate(file_paths)
+    pending = {}
+    exhausted = False
+    while True:
+        # Only block for a free slot when there is nothing left to wait on
+        while not exhausted and slots.acquire(blocking=not pending):
+            next_file = next(remaining, None)
+            if next_file is None:
+                slots.release()
+                exhausted = True
+                break
+            index, file_path = next_file
+            pending[executor.submit(decode_timed, file_path, **decode_options)] = index
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            frame, timings = future.result()
+            yield pending.pop(future), frame, timings
+
+
+class RunningStack:
+    """Base for stacks that fold each frame into one preallocated buffer.
+
+    With ``memory_mapped`` the buffer lives in a temporary file in ``spill_dir``
+    and is left to the OS page cache instead of being held in RAM.
+    """
+
+    def __init__(self, memory_mapped=False, spill_dir=None):
+        self.count = 0
+        self.memory_mapped = memory_mapped
+        self.spill_dir = spill_dir
+        self._buffer = None
+        self._buffer_path = None
+
+    @property
+    def shape(self):
+        return self._buffer.shape
+
+    def add(self, index, frame):
+        """Fold a decoded frame into the running buffer in place."""
+        if self._buffer is None:
+            if self.memory_mapped:
+                self._buffer, self._buffer_path = create_spill_file(frame.shape, self.dtype, self.spill_dir)
+            else:
+                self._buffer = np.empty(frame.shape, dtype=self.dtype)
+            np.copyto(self._buffer, frame)
+        else:
+            self.accumulate(self._buffer, frame)
+        self.count += 1
+
+    def finish(self, block):
+        """Stacked float32 values for a block of the running buffer."""
+        return np.asarray(block, dtype=np.float32)
+
+    def preview(self):
+        """Current stacked image for display."""
+        return self.result()
+
+    def result(self):
+        """Stacked image as float32."""
+        return self.finish(self._buffer)
+
+    def iter_rows(self, rows):
+        """Stacked image as float32 blocks of ``rows`` rows."""
+        for start in range(0, self._buffer.shape[0], rows):
+            yield self.finish(self._buffer[start:start + rows])
+
+    def save_checkpoint(self, directory, state):
+        """Save the running buffer and ``state`` in a checkpoint folder.
+
+        The buffer goes to a new file named after the frame count, and the old
+        one is only removed once the state pointing at the new one is written.
+        """
+        buffer_name = f"buffer-{self.count}.npy"
+        temp_path = os.path.join(directory, buffer_name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, self._buffer)
+        os.replace(temp_path, os.path.join(directory, buffer_name))
+        state['stack'] = {'buffer': buffer_name, 'count': self.count}
+        write_json_atomic(os.path.join(directory, CHECKPOINT_STATE), state)
+        for name in os.listdir(directory):
+            if name.startswith('buffer-') and name != buffer_name:
+                os.remove(os.path.join(directory, name))
+
+    def load_checkpoint(self, directory, state):
+        """Restore the running buffer from a checkpoint folder."""
+        saved = np.load(os.path.join(directory, state['stack']['buffer']))
+        if self.memory_mapped:
+            self._buffer, self._buffer_path = create_spill_file(saved.shape, self.dtype, self.spill_dir)
+            np.copyto(self._buffer, saved)
+        else:
+            self._buffer = saved
+        self.count = state['stack']['count']
+
+    def close(self):
+        """Release the running buffer and its backing file."""
+        # Drop the mapping first so the file can be removed on Windows
+        self._buffer = None
+        if self._buffer_path is not None:
+            os.remove(self._buffer_path)
+            self._buffer_path = None
+
+
+class MeanStack(RunningStack):
+    """Mean of the frames, kept as a float64 sum and divided only when read."""
+
+    dtype = np.float64
+
+    def accumulate(self, buffer, frame):
+        np.add(buffer, frame, out=buffer)
+
+    def finish(self, block):
+        mean = np.empty(block.shape, dtype=np.float32)
+        np.divide(block, self.count, out=mean)
+        return mean
+
+
+class MaximumStack(RunningStack):
+    """Per-pixel maximum of the frames."""
+
+    dtype = np.float32
+
+    def accumulate(self, buffer, frame):
+        np.maximum(buffer, frame, out=buffer)
+
+
+class MinimumStack(RunningStack):
+    """Per-pixel minimum of the frames."""
+
+    dtype = np.float32
+
+    def accumulate(self, buffer, frame):
+        np.minimum(buffer, frame, out=buffer)
+
+
+def sigma_clip_band(band, sigma):
+    """Sigma clipped mean of a (frames, rows, ...) block along the frame axis."""
+    stack = np.asarray(band, dtype=np.float32)
+    # Compute mean and standard deviation along the stack axis
+    mean = np.mean(stack, axis=0)
+    std = np.std(stack, axis=0)
+    # Create a mask of values within the sigma threshold
+    mask = np.abs(stack - mean) <= sigma * std
+    # Replace outliers with NaN
+    clipped_stack = np.where(mask, stack, np.nan)
+    # Compute mean ignoring NaN values
+    clipped_mean = np.nanmean(clipped_stack, axis=0)
+    # Replace NaN values with zeros
+    return np.nan_to_num(clipped_mean)
+
+
+class SigmaClipStack:
+    """Sigma clipping that spills frames to disk and clips one band of rows at a time.
+
+    Frames are stored in their decoded dtype in a memory-mapped spill file, so
+    RAM use is bounded by ``memory_limit`` instead of growing with the number
+    of frames. The result matches clipping the whole in-memory stack at once.
+    A ``spill_path`` is kept after closing, so the frames can be checkpointed.
+    """
+
+    def __init__(self, total_frames, sigma=2, memory_limit=DEFAULT_MEMORY_LIMIT, spill_dir=None, spill_path=None):
+        self.total_frames = total_frames
+        self.sigma = sigma
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self._spill = None
+        self._spill_path = spill_path
+        self._keep_spill = spill_path is not None
+        self._filled = set()
+
+    @property
+    def shape(self):
+        return self._spill.shape[1:]
+
+    def add(self, index, frame):
+        """Store a decoded frame in its slot of the spill file."""
+        if self._spill is None:
+            shape = (self.total_frames,) + frame.shape
+            if self._keep_spill:
+                self._spill = open_spill_file(self._spill_path, shape, frame.dtype)
+            else:
+                self._spill, self._spill_path = create_spill_file(shape, frame.dtype, self.spill_dir)
+        self._spill[index] = frame
+        self._filled.add(index)
+
+    def filled_frames(self):
+        """Index of the filled slots along the frame axis; a plain slice when all are filled."""
+        if len(self._filled) == self.total_frames:
+            return slice(None)
+        return np.array(sorted(self._filled))
+
+    def preview(self):
+        """Clipping needs every frame, so there is nothing to show until the end."""
+        return None
+
+    def band_rows(self):
+        """Number of image rows clipped per band to stay under the memory limit."""
+        frames, height = len(self._filled), self._spill.shape[1]
+        samples_per_row = int(np.prod(self._spill.shape[2:]))
+        bytes_per_row = frames * samples_per_row * BAND_BYTES_PER_SAMPLE
+        return max(1, min(height, self.memory_limit // bytes_per_row))
+
+    def iter_rows(self, rows):
+        """Sigma clipped mean as float32 blocks of ``rows`` rows."""
+        height = self._spill.shape[1]
+        band_rows = self.band_rows()
+        frames = self.filled_frames()
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            block = np.empty((stop - start,) + self.shape[1:], dtype=np.float32)
+            # Blocks taller than the memory limit allows are clipped in several bands
+            for band_start in range(start, stop, band_rows):
+                band_stop = min(band_start + band_rows, stop)
+                block[band_start - start:band_stop - start] = sigma_clip_band(
+                    self._spill[frames, band_start:band_stop], self.sigma)
+            yield block
+
+    def result(self):
+        """Sigma clipped mean of all added frames as a float32 image."""
+        rows = self.band_rows()
+        result = np.empty(self.shape, dtype=np.float32)
+        for start, block in zip(range(0, self.shape[0], rows), self.iter_rows(rows)):
+            result[start:start + rows] = block
+        return result
+
+    def save_checkpoint(self, directory, state):
+        """Flush the spilled frames and save ``state`` in a checkpoint folder."""
+        self._spill.flush()
+        state['stack'] = {'shape': list(self.shape), 'dtype': self._spill.dtype.str}
+        write_json_atomic(os.path.join(directory, CHECKPOINT_STATE), state)
+
+    def load_checkpoint(self, directory, state):
+        """Reopen the spilled frames of a checkpoint, growing the file for new slots."""
+        shape = (self.total_frames,) + tuple(state['stack']['shape'])
+        self._spill = open_spill_file(self._spill_path, shape, state['stack']['dtype'])
+        self._filled = set(slot for slot, path in enumerate(state['files']) if path)
+
+    def close(self):
+        """Release the spill file, deleting it unless it belongs to a checkpoint."""
+        # Drop the mapping first so the file can be removed on Windows
+        self._spill = None
+        if self._spill_path is not None and not self._keep_spill:
+            os.remove(self._spill_path)
+            self._spill_path = None
+
+
+STACKING_METHODS = {
+    'Mean': MeanStack,
+    'Maximum': MaximumStack,
+    'Minimum': MinimumStack,
+    'Sigma Clipping': SigmaClipStack,
+}
+
+
+def create_stack(stacking_method, total_frames, memory_limit=DEFAULT_MEMORY_LIMIT, memory_mapped=False,
+                 spill_path=None):
+    """Create the stack for a stacking method name as shown in the UI."""
+    if stacking_method == 'Sigma Clipping':
+        return SigmaClipStack(total_frames, sigma=2, memory_limit=memory_limit, spill_path=spill_path)
+    return STACKING_METHODS[stacking_method](memory_mapped=memory_mapped)
+
+
+def benchmark_stack(stacking_method, frames=50, shape=(2000, 3000, 3)):
+    """Frames per second a stack folds in, using random 8-bit frames."""
+    rng = np.random.default_rng(0)
+    frame_pool = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(4)]
+    frame_stack = create_stack(stacking_method, frames)
+    try:
+        start = time.perf_counter()
+        for index in range(frames):
+            frame_stack.add(index, frame_pool[index % len(frame_pool)])
+        frame_stack.result()
+        return frames / (time.perf_counter() - start)
+    finally:
+        frame_stack.close()
+
+
+def stack(file_paths, stacking_method='Mean', output_path=None, workers=None,
+          memory_limit=DEFAULT_MEMORY_LIMIT, frames_in_flight=None,
+          progress=None, preview=None, executor=None, quick_look=False, bayer=False,
+          bit_depth=8, memory_mapped=False, checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL,
+          save=True, metrics=None, register=None, profile=DEFAULT_PROFILE, cache=None):
+    """Stack RAW files and save the result as a TIFF, returning the output path.
+
+    ``progress(done, total, message)`` is called as frames are stacked and
+    ``preview(image)`` every PREVIEW_INTERVAL frames and with the final image.
+    Pass an ``executor`` to reuse one decode pool across several stacks.
+    ``quick_look`` stacks small frames from the embedded previews or half-size
+    decodes, to check a sequence in seconds before the full-quality stack.
+    ``bayer`` stacks the undemosaiced sensor data and demosaics only the
+    result, using the first file's LibRaw settings.
+    The TIFF is written strip by strip with 8 or 16-bit integer or 32-bit
+    float samples (``bit_depth``); ``memory_mapped`` keeps the running buffer
+    in a temporary file. With ``save`` off nothing is written and None is returned.
+
+    With a ``checkpoint`` folder the stack state is saved there every
+    ``checkpoint_interval`` frames and when decoding is done. A later call with
+    the same checkpoint skips files already in the stack, so an interrupted
+    stack resumes where it stopped and new files can be added to a finished
+    one. Files from the checkpoint stay in the stack even if they aren't passed again.
+
+    ``metrics`` is a StackMetrics that times the decode, queue wait,
+    accumulate and save stages and samples throughput and memory use.
+    ``register`` ('translation' or 'homography') aligns each frame to the
+    first one in the decode workers before it is stacked.
+    ``profile`` names the raw_decode profile frames (or a Bayer stack) are developed with.
+    Decoded frames are kept in and reused from a FrameCache passed as ``cache``.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        raise ValueError("No files to stack.")
+    if stacking_method not in STACKING_METHODS:
+        raise ValueError(f"Unknown stacking method: {stacking_method}")
+    if quick_look and bayer:
+        raise ValueError("Quick look and Bayer stacking can't be combined.")
+    if register and register not in REGISTRATION_MODES:
+        raise ValueError(f"Unknown registration mode: {register}")
+    if profile not in DECODE_PROFILES:
+        raise ValueError(f"Unknown decode profile: {profile}")
+    if register and bayer:
+        raise ValueError("Registration needs demosaiced frames, so it can't be combined with Bayer stacking.")
+    if bit_depth not in OUTPUT_DTYPES:
+        raise ValueError(f"Unsupported output bit depth: {bit_depth}")
+    workers = workers or os.cpu_count() or 1
+    frames_in_flight = frames_in_flight or workers * FRAMES_IN_FLIGHT_PER_WORKER
+
+    # Slots hold the files stacked so far, None for a slot still waiting for its frame
+    slot_paths = []
+    saved_exposure_time = Fraction(0)
+    reference_path = None
+    session = {'method': stacking_method, 'quick_look': quick_look, 'bayer': bayer, 'register': register,
+               'profile': profile}
+    if checkpoint:
+        os.makedirs(checkpoint, exist_ok=True)
+        state = load_checkpoint_state(checkpoint)
+        if state is not None:
+            for key, value in session.items():
+                if state.get(key) != value:
+                    raise ValueError(f"Checkpoint {checkpoint} was made with {key}={state.get(key)!r}, not {value!r}.")
+            slot_paths = state['files']
+            saved_exposure_time = Fraction(state['exposure_time'])
+            reference_path = state.get('reference')
+    stacked = set(path for path in slot_paths if path)
+    new_paths = [path for path in dict.fromkeys(os.path.abspath(p) for p in file_paths) if path not in stacked]
+    # New files take any free slots first
+    new_slots = [slot for slot, path in enumerate(slot_paths) if path is None][:len(new_paths)]
+    while len(new_slots) < len(new_paths):
+        new_slots.append(len(slot_paths))
+        slot_paths.append(None)
+    total_files = len(stacked) + len(new_paths)
+    if register and reference_path is None:
+        reference_path = next(path for path in slot_paths + new_paths if path)
+
+    if metrics is None:
+        metrics = StackMetrics()
+    metrics.start(method=stacking_method, files=total_files, new_files=len(new_paths),
+                  workers=workers, quick_look=quick_look, bayer=bayer, bit_depth=bit_depth, register=register,
+                  profile=profile)
+
+    def report(done, message):
+        if progress is not None:
+            progress(done, total_files, message)
+
+    with metrics.time('exposure_scan'):
+        exposure_times = dict(zip(new_paths, scan_exposure_times(new_paths))) if save or checkpoint else {}
+    if save:
+        total_exposure_time = saved_exposure_time + sum(exposure_times.values(), Fraction(0))
+        if output_path is None:
+            method_name = stacking_method
+            if quick_look:
+                method_name += "_quicklook"
+            elif bayer:
+                method_name += "_bayer"
+            output_path = default_output_path(file_paths, method_name, total_exposure_time)
+
+    if bayer:
+        with rawpy.imread(file_paths[0]) as raw:
+            white_level = raw.white_level
+
+    spill_path = os.path.join(checkpoint, CHECKPOINT_SPILL) if checkpoint else None
+    frame_stack = create_stack(stacking_method, len(slot_paths), memory_limit, memory_mapped, spill_path)
+
+    def save_checkpoint():
+        exposure_time = saved_exposure_time + sum(
+            (exposure_times[path] for path in slot_paths if path and path not in stacked), Fraction(0))
+        state = dict(session, files=slot_paths, exposure_time=str(exposure_time), reference=reference_path)
+        with metrics.time('checkpoint'):
+            frame_stack.save_checkpoint(checkpoint, state)
+
+    if stacked:
+        frame_stack.load_checkpoint(checkpoint, state)
+        report(len(stacked), f"Resumed {len(stacked)} images from the checkpoint")
+
+    own_executor = executor is None
+    if own_executor:
+        executor = create_executor(workers)
+    processed_count = len(stacked)
+    try:
+        try:
+            report(processed_count, "Starting to process images...")
+            decode_options = {'quick_look': quick_look, 'bayer': bayer, 'profile': profile, 'cache': cache}
+            if register and new_paths:
+                with metrics.time('reference'):
+                    reference = executor.submit(decode_reference, reference_path, quick_look, profile).result()
+                decode_options.update(register=register, reference=reference)
+            in_flight = threading.Semaphore(frames_in_flight)
+            wait_start = time.perf_counter()
+            for index, img, timings in decode_frames(executor, new_paths, in_flight, **decode_options):
+                timings['queue_wait'] = time.perf_counter() - wait_start
+                slot = new_slots[index]
+                accumulate_start = time.perf_counter()
+                frame_stack.add(slot, img)
+                timings['accumulate'] = time.perf_counter() - accumulate_start
+                del img
+                slot_paths[slot] = new_paths[index]
+                # Let the decoders start on another frame
+                in_flight.release()
+                processed_count += 1
+                report(processed_count, f"Processed image {processed_count}/{total_files}")
+                metrics.frame(new_paths[index], timings)
+                if checkpoint and processed_count % checkpoint_interval == 0 and processed_count < total_files:
+                    save_checkpoint()
+                if preview is not None and processed_count % PREVIEW_INTERVAL == 0 and processed_count < total_files:
+                    with metrics.time('preview'):
+                        preview_image = frame_stack.preview()
+                        if preview_image is not None:
+                            preview(bayer_preview(preview_image, white_level) if bayer else preview_image)
+                wait_start = time.perf_counter()
+        finally:
+            if own_executor:
+                executor.shutdown()
+        if checkpoint and new_paths:
+            save_checkpoint()
+
+        if bayer:
+            report(total_files, "Demosaicing the stack...")
+            output_bps = 8 if bit_depth == 8 else 16
+            with metrics.time('demosaic'):
+                rgb_image = demosaic_bayer_stack(file_paths[0], frame_stack.result(), output_bps, profile)
+            frame_stack.close()
+            shape = rgb_image.shape
+            strips = image_strips(rgb_image, OUTPUT_STRIP_ROWS, 255 / (2 ** output_bps - 1))
+        else:
+            # The result is only ever materialised one strip at a time
+            shape = frame_stack.shape
+            strips = frame_stack.iter_rows(OUTPUT_STRIP_ROWS)
+        previews = []
+        strips = sample_strips(tap_preview(strips, shape, previews), metrics)
+
+        # Sigma clipping of RGB stacks happens band by band as the strips are produced
+        clipping = stacking_method == 'Sigma Clipping' and not bayer
+        if save:
+            action = "Sigma clipping and saving" if clipping else "Saving"
+            report(total_files, f"{action} {os.path.basename(output_path)}...")
+            with metrics.time('save'):
+                save_stack(strips, shape, output_path, total_exposure_time, bit_depth)
+        else:
+            if clipping:
+                report(total_files, "Sigma clipping...")
+            with metrics.time('finish'):
+                for _ in strips:
+                    pass
+    finally:
+        frame_stack.close()
+
+    if preview is not None:
+        preview(np.concatenate(previews))
+    metrics.finish(output=output_path if save else None)
+    report(total_files, "Finished!")
+    return output_path if save else None
+
+
+def expand_inputs(patterns):
+    """Expand file names and glob patterns into a sorted list of files."""
+    file_paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        file_paths.extend(matches if matches else [pattern])
+    return file_paths
+
+
+def load_jobs(manifest_path):
+    """Read a JSON job manifest: a list of jobs, or an object with a "jobs" list.
+
+    Each job has "files" (names or glob patterns) and optionally "method",
+    "output", "memory_limit_mb", "quick_look", "bayer", "bit_depth", "memmap",
+    "checkpoint", "register" and "profile". Relative paths are taken from the manifest's folder.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    jobs = manifest['jobs'] if isinstance(manifest, dict) else manifest
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for job in jobs:
+        files = job['files']
+        if isinstance(files, str):
+            files = [files]
+        job['files'] = expand_inputs([os.path.join(base_dir, pattern) for pattern in files])
+        for key in ('output', 'checkpoint'):
+            if job.get(key):
+                job[key] = os.path.join(base_dir, job[key])
+    return jobs
+
+
+def run_jobs(jobs, workers=None, progress=None, metrics=None, cache=None):
+    """Run stacking jobs back to back on one shared decode pool and frame ``cache``, timing them all with ``metrics``."""
+    workers = workers or os.cpu_count() or 1
+    output_paths = []
+    with create_executor(workers) as executor:
+        for job in jobs:
+            memory_limit = job.get('memory_limit_mb')
+            output_paths.append(stack(
+                job['files'],
+                stacking_method=job.get('method', 'Mean'),
+                output_path=job.get('output'),
+                workers=workers,
+                memory_limit=memory_limit * 1024 ** 2 if memory_limit else DEFAULT_MEMORY_LIMIT,
+                progress=progress,
+                executor=executor,
+                quick_look=job.get('quick_look', False),
+                bayer=job.get('bayer', False),
+                bit_depth=job.get('bit_depth', 8),
+                memory_mapped=job.get('memmap', False),
+                checkpoint=job.get('checkpoint'),
+                metrics=metrics,
+                register=job.get('register'),
+                profile=job.get('profile', DEFAULT_PROFILE),
+                cache=cache,
+            ))
+    return output_paths
+
+
+def print_progress(done, total, message):
+    print(f"[{done}/{total}] {message}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stack DNG files without the UI.")
+    parser.add_argument('files', nargs='*', help="DNG files or glob patterns to stack")
+    parser.add_argument('-m', '--method', default='Mean', choices=list(STACKING_METHODS), help="stacking method")
+    parser.add_argument('-o', '--output', help="output TIFF path (default: named after the first file)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="decode worker processes")
+    parser.add_argument('--memory-limit', type=int, default=DEFAULT_MEMORY_LIMIT // 1024 ** 2,
+                        help="sigma clipping memory limit in MB")
+    parser.add_argument('--quick-look', action='store_true',
+                        help="fast low-resolution stack from embedded previews or half-size decodes")
+    parser.add_argument('--bayer', action='store_true',
+                        help="stack the raw Bayer data and demosaic only the result")
+    parser.add_argument('--bit-depth', type=int, default=8, choices=sorted(OUTPUT_DTYPES),
+                        help="output TIFF bit depth; 32 writes float samples")
+    parser.add_argument('--memmap', action='store_true',
+                        help="keep the running stack in a memory-mapped temporary file")
+    parser.add_argument('--checkpoint',
+                        help="folder to checkpoint the stack in; resumes it or adds new files to it")
+    parser.add_argument('--register', choices=REGISTRATION_MODES,
+                        help="align each frame to the first before stacking")
+    parser.add_argument('--profile', default=DEFAULT_PROFILE, choices=list(DECODE_PROFILES),
+                        help="RAW decode profile; 'full' develops 16-bit frames")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep decoded frames on disk so restacking the same files skips decoding")
+    parser.add_argument('--cache-dir', default=FRAME_CACHE_DIR, help="decoded frame cache folder")
+    parser.add_argument('--cache-limit', type=float, default=FRAME_CACHE_LIMIT / 1024 ** 3,
+                        help="decoded frame cache size in GB; the least recently used frames go first")
+    parser.add_argument('--jobs', help="JSON manifest of stacks to run back to back")
+    parser.add_argument('--metrics', metavar='LOG',
+                        help="append per-stage timings, frames/s and memory use to a JSON-lines log")
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help="seconds between metrics samples")
+    args = parser.parse_args(argv)
+
+    if args.jobs:
+        jobs = load_jobs(args.jobs)
+    elif args.files:
+        jobs = [{'files': expand_inputs(args.files), 'method': args.method,
+                 'output': args.output, 'memory_limit_mb': args.memory_limit,
+                 'quick_look': args.quick_look, 'bayer': args.bayer,
+                 'bit_depth': args.bit_depth, 'memmap': args.memmap,
+                 'checkpoint': args.checkpoint, 'register': args.register,
+                 'profile': args.profile}]
+    else:
+        parser.error("give files to stack or a --jobs manifest")
+
+    metrics = StackMetrics(args.metrics, interval=args.metrics_interval) if args.metrics else None
+    try:
+        cache = FrameCache(args.cache_dir, int(args.cache_limit * 1024 ** 3)) if args.cache else None
+        for output_path in run_jobs(jobs, workers=args.workers, progress=print_progress, metrics=metrics,
+                                    cache=cache):
+            print(f"Saved stacked image to: {output_path}")
+    finally:
+        if metrics is not None:
+            metrics.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
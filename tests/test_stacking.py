@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import numpy as np
+import pytest
+import stacking
+from stacking import SigmaClipStack
+
+
+def in_memory_sigma_clip(frames, sigma=2):
+    """The sigma clipping DNGstacker did before spilling, on the whole np.stack of frames."""
+    stack = np.stack(frames, axis=0)
+    mean = np.mean(stack, axis=0)
+    std = np.std(stack, axis=0)
+    mask = np.abs(stack - mean) <= sigma * std
+    clipped_stack = np.where(mask, stack, np.nan)
+    average_image = np.nanmean(clipped_stack, axis=0)
+    return np.nan_to_num(average_image)
+
+
+def noisy_frames(count=9, shape=(37, 23, 3)):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(count)]
+    # A satellite trail and a flat patch, so some pixels are clipped and some have no spread
+    frames[3][5:9] = 255
+    for frame in frames:
+        frame[20:24, 10:14] = 128
+    return frames
+
+
+@pytest.mark.parametrize('memory_limit', [1, 64 * 1024, 2 * 1024 ** 3])
+def test_sigma_clip_matches_in_memory_stack(tmp_path, memory_limit):
+    frames = noisy_frames()
+    frame_stack = SigmaClipStack(len(frames), memory_limit=memory_limit, spill_dir=tmp_path)
+    try:
+        for index, frame in enumerate(frames):
+            frame_stack.add(index, frame)
+        if memory_limit == 1:
+            assert frame_stack.band_rows() == 1
+        result = frame_stack.result()
+        blocks = np.concatenate(list(frame_stack.iter_rows(5)))
+    finally:
+        frame_stack.close()
+    expected = in_memory_sigma_clip(frames)
+    assert result.dtype == np.float32
+    assert np.array_equal(result, expected.astype(np.float32))
+    assert np.array_equal(blocks, result)
+    # And so the saved 8-bit image is the same too
+    assert np.array_equal(np.clip(result, 0, 255).astype(np.uint8), np.clip(expected, 0, 255).astype(np.uint8))
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.fixture
+def fake_decode(monkeypatch, tmp_path):
+    """Eight frame files whose decode is a seeded random frame, failing for any path in ``fail``."""
+    paths = []
+    for index in range(8):
+        path = tmp_path / f"f{index:03}.dng"
+        path.write_bytes(b'')
+        paths.append(str(path))
+    fail = set()
+
+    def decode_timed(file_path, **decode_options):
+        if file_path in fail:
+            raise RuntimeError(f"Interrupted at {file_path}")
+        seed = paths.index(file_path)
+        return np.random.default_rng(seed).integers(0, 256, (12, 10, 3), dtype=np.uint8), {}
+
+    monkeypatch.setattr(stacking, 'decode_timed', decode_timed)
+    monkeypatch.setattr(stacking, 'scan_exposure_times', lambda file_paths: [Fraction(1, 4)] * len(file_paths))
+    return paths, fail
+
+
+def stacked_image(file_paths, stacking_method, **options):
+    """Final stacked image of a run that saves nothing, taken from its preview."""
+    previews = []
+    with ThreadPoolExecutor(1) as executor:
+        stacking.stack(file_paths, stacking_method, executor=executor, frames_in_flight=1, save=False,
+                       preview=previews.append, **options)
+    return previews[-1]
+
+
+@pytest.mark.parametrize('stacking_method', ['Mean', 'Sigma Clipping'])
+def test_checkpoint_resume(tmp_path, fake_decode, stacking_method):
+    paths, fail = fake_decode
+    expected = stacked_image(paths, stacking_method)
+
+    checkpoint = tmp_path / 'checkpoint'
+    fail.add(paths[5])
+    with pytest.raises(RuntimeError, match="Interrupted"):
+        stacked_image(paths, stacking_method, checkpoint=str(checkpoint), checkpoint_interval=2)
+    state = stacking.load_checkpoint_state(str(checkpoint))
+    assert [path for path in state['files'] if path] == paths[:4]
+    assert Fraction(state['exposure_time']) == 1
+
+    fail.clear()
+    messages = []
+    previews = []
+    with ThreadPoolExecutor(1) as executor:
+        stacking.stack(paths, stacking_method, executor=executor, frames_in_flight=1, save=False,
+                       checkpoint=str(checkpoint), checkpoint_interval=2, preview=previews.append,
+                       progress=lambda done, total, message: messages.append(message))
+    assert "Resumed 4 images from the checkpoint" in messages
+    assert np.array_equal(previews[-1], expected)
+    state = stacking.load_checkpoint_state(str(checkpoint))
+    assert state['files'] == paths
+    assert Fraction(state['exposure_time']) == 2
@@ -0,0 +1,47 @@
+from fractions import Fraction
+import numpy as np
+import pytest
+from PIL import Image
+from tiff_writer import write_tiff
+
+
+def strips_of(image, rows):
+    for start in range(0, image.shape[0], rows):
+        yield image[start:start + rows]
+
+
+@pytest.mark.parametrize('shape, dtype', [
+    ((45, 31, 3), np.uint8),
+    ((45, 31), np.uint16),
+    ((45, 31), np.float32),
+])
+def test_round_trip(tmp_path, shape, dtype):
+    rng = np.random.default_rng(0)
+    if np.dtype(dtype).kind == 'f':
+        image = rng.random(shape, dtype=dtype)
+    else:
+        image = rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype, endpoint=True)
+    path = tmp_path / 'out.tiff'
+    # 45 rows in strips of 8 leaves a short last strip
+    write_tiff(path, image.shape, image.dtype, strips_of(image, 8), 8, exposure_time=Fraction(5, 2))
+    with Image.open(path) as saved:
+        assert np.array_equal(np.asarray(saved), image)
+        assert saved.tag_v2[33434] == Fraction(5, 2)
+
+
+def test_too_large_is_rejected_before_writing(tmp_path):
+    path = tmp_path / 'huge.tiff'
+
+    def strips():
+        pytest.fail("No strip should be asked for")
+        yield
+
+    with pytest.raises(ValueError, match="too large"):
+        write_tiff(path, (40000, 40000, 3), np.uint8, strips(), 16)
+    assert not path.exists()
+
+
+def test_wrong_strip_shape(tmp_path):
+    image = np.zeros((10, 4, 3), dtype=np.uint8)
+    with pytest.raises(ValueError, match="doesn't fit"):
+        write_tiff(tmp_path / 'out.tiff', (10, 5, 3), np.uint8, strips_of(image, 4), 4)
@@ -0,0 +1,94 @@
+import io
+import os
+import numpy as np
+import rawpy
+from PIL import Image, ImageOps
+from frame_cache import CACHE_DIR, FrameCache, cached_decode
+from raw_decode import decode_raw
+
+# A folder of its own, so thumbnails and decoded frames are evicted separately
+THUMBNAIL_CACHE_DIR = os.path.join(CACHE_DIR, "thumbnails")
+
+# A 100 px thumbnail is about 30 KB, so this keeps thousands of them
+THUMBNAIL_CACHE_LIMIT = 512 * 1024 ** 2
+
+# Longest side of a thumbnail in pixels
+THUMBNAIL_SIZE = 100
+
+# rawpy's sizes.flip as the transpose that puts an embedded preview upright
+RAW_FLIPS = {3: Image.Transpose.ROTATE_180, 5: Image.Transpose.ROTATE_90, 6: Image.Transpose.ROTATE_270}
+
+
+def raw_preview(raw, size=THUMBNAIL_SIZE):
+    """The preview a camera embedded in an open rawpy image, upright like postprocess output, or None.
+
+    JPEG previews are decoded only as far as needed for ``size`` pixels on
+    each side.
+    """
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        image = Image.open(io.BytesIO(thumb.data))
+        # Lets the JPEG decoder skip straight to a fraction of the full size
+        image.draft('RGB', (size, size))
+    elif thumb.format == rawpy.ThumbFormat.BITMAP:
+        image = Image.fromarray(thumb.data)
+    else:
+        return None
+    flip = raw.sizes.flip
+    return image.transpose(RAW_FLIPS[flip]) if flip in RAW_FLIPS else image
+
+
+def embedded_preview(file_path, size=THUMBNAIL_SIZE):
+    """The preview a camera embeds in a RAW file, or None if it has no usable one."""
+    with rawpy.imread(file_path) as raw:
+        return raw_preview(raw, size)
+
+
+def load_scaled(file_path, box, frame_cache=None):
+    """Decode an image scaled down to fit in a (width, height) box, as an RGB uint8 array.
+
+    DNGs use their embedded preview if it's big enough for the box, which is
+    far cheaper than even a half-size demosaic. Otherwise they are decoded
+    with the 'preview' profile, through ``frame_cache`` if one is given.
+    """
+    if file_path.lower().endswith('.dng'):
+        image = embedded_preview(file_path, max(box))
+        if image is not None and image.width < box[0] and image.height < box[1]:
+            image = None
+        if image is None:
+            frame = cached_decode(frame_cache, file_path, {'profile': 'preview'}, decode_raw)
+            image = Image.fromarray(np.asarray(frame))
+    else:
+        image = Image.open(file_path)
+        # Square, so the draft is big enough whichever way EXIF turns it
+        image.draft('RGB', (max(box), max(box)))
+        image = ImageOps.exif_transpose(image)
+    image = image.convert('RGB')
+    image.thumbnail(box, Image.LANCZOS)
+    return np.asarray(image)
+
+
+def load_thumbnail(file_path, size=THUMBNAIL_SIZE):
+    """Decode a small RGB thumbnail of an image as a uint8 array."""
+    return load_scaled(file_path, (size, size))
+
+
+class ThumbnailCache:
+    """Thumbnails kept on disk between runs, decoding only the ones that are missing.
+
+    Safe to share between threads; the memory cache of ready-to-draw
+    thumbnails is left to the GUI.
+    """
+
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, max_bytes=THUMBNAIL_CACHE_LIMIT, size=THUMBNAIL_SIZE):
+        self.disk = FrameCache(directory, max_bytes)
+        self.size = size
+
+    def get(self, file_path):
+        thumbnail = cached_decode(self.disk, file_path, {'thumbnail': self.size},
+                                  lambda path, thumbnail: load_thumbnail(path, thumbnail))
+        # Cached thumbnails come back as read-only maps of the file
+        return np.array(thumbnail)
@@ -0,0 +1,110 @@
+import struct
+from fractions import Fraction
+import numpy as np
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+
+# Largest offset a classic (non-BigTIFF) file can hold
+MAX_TIFF_BYTES = 2 ** 32 - 1
+
+
+def write_tiff(path, shape, dtype, strips, rows_per_strip, exposure_time=None):
+    """Write an image to a baseline TIFF one strip at a time.
+
+    ``shape`` is (height, width) or (height, width, samples) and ``strips``
+    yields blocks of ``rows_per_strip`` rows (the last one may be shorter) in
+    ``dtype``, so only one strip has to be in memory. Unsigned integer and
+    float samples are supported. ``exposure_time`` is stored as ExposureTime.
+    """
+    height, width = shape[:2]
+    samples = shape[2] if len(shape) > 2 else 1
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'uf':
+        raise ValueError(f"Unsupported TIFF sample type: {dtype}")
+    # TIFF data is written little-endian to match the 'II' header
+    strip_dtype = dtype.newbyteorder('<')
+    # Every offset has to fit in 32 bits, so check before writing gigabytes of strips
+    if tiff_size(shape, dtype, rows_per_strip) > MAX_TIFF_BYTES:
+        raise ValueError(f"A {width}x{height} {dtype} image is too large for a classic TIFF")
+
+    strip_offsets = []
+    strip_byte_counts = []
+    with open(path, 'wb') as f:
+        # Header, with the IFD offset patched in once the strips are written
+        f.write(b'II' + struct.pack('<HI', 42, 0))
+        rows_written = 0
+        for strip in strips:
+            strip = np.ascontiguousarray(strip, dtype=strip_dtype)
+            expected_rows = min(rows_per_strip, height - rows_written)
+            if strip.shape[0] != expected_rows or strip.shape[1:] != tuple(shape[1:]):
+                raise ValueError(f"Strip of shape {strip.shape} doesn't fit image {shape} at row {rows_written}")
+            strip_offsets.append(f.tell())
+            strip_byte_counts.append(strip.nbytes)
+            f.write(memoryview(strip).cast('B'))
+            rows_written += strip.shape[0]
+        if rows_written != height:
+            raise ValueError(f"Got {rows_written} rows for an image of height {height}")
+
+        bits = dtype.itemsize * 8
+        sample_format = 3 if dtype.kind == 'f' else 1
+        entries = [
+            (256, LONG, [width]),
+            (257, LONG, [height]),
+            (258, SHORT, [bits] * samples),
+            (259, SHORT, [1]),  # No compression
+            (262, SHORT, [2 if samples >= 3 else 1]),  # RGB or min-is-black
+            (273, LONG, strip_offsets),
+            (277, SHORT, [samples]),
+            (278, LONG, [rows_per_strip]),
+            (279, LONG, strip_byte_counts),
+            (284, SHORT, [1]),  # Chunky samples
+            (339, SHORT, [sample_format] * samples),
+        ]
+        if samples == 4:
+            entries.append((338, SHORT, [2]))  # Unassociated alpha
+        if exposure_time is not None:
+            exposure_time = Fraction(exposure_time).limit_denominator(MAX_TIFF_BYTES)
+            entries.append((33434, RATIONAL, [(exposure_time.numerator, exposure_time.denominator)]))
+        entries.sort()
+        write_ifd(f, entries)
+
+
+def tiff_size(shape, dtype, rows_per_strip):
+    """Upper bound on the bytes write_tiff writes for an image, known before any strip is."""
+    height, width = shape[:2]
+    samples = shape[2] if len(shape) > 2 else 1
+    strips = -(-height // rows_per_strip)
+    image_bytes = height * width * samples * np.dtype(dtype).itemsize
+    # Header, padding, up to 13 IFD entries, the strip offsets and byte counts,
+    # the per-sample bits and formats and the exposure time rational
+    return 8 + image_bytes + 1 + 2 + 13 * 12 + 4 + strips * 8 + samples * 4 + 8 + 4
+
+
+def write_ifd(f, entries):
+    """Append an IFD for (tag, type, values) entries and point the header at it."""
+    # Values that don't fit in the 4-byte entry field go after the IFD
+    ifd_offset = f.tell() + (f.tell() & 1)
+    data_offset = ifd_offset + 2 + len(entries) * 12 + 4
+    ifd = struct.pack('<H', len(entries))
+    extra = b''
+    for tag, field_type, values in entries:
+        if field_type == RATIONAL:
+            packed = b''.join(struct.pack('<II', *value) for value in values)
+        else:
+            packed = struct.pack('<%d%s' % (len(values), 'H' if field_type == SHORT else 'I'), *values)
+        if len(packed) <= 4:
+            field = packed.ljust(4, b'\0')
+        else:
+            field = struct.pack('<I', data_offset + len(extra))
+            extra += packed + b'\0' * (len(packed) & 1)
+        ifd += struct.pack('<HHI', tag, field_type, len(values)) + field
+    ifd += struct.pack('<I', 0)  # No further IFDs
+
+    f.seek(ifd_offset)
+    f.write(ifd + extra)
+    f.seek(4)
+    f.write(struct.pack('<I', ifd_offset))
+    f.seek(0, 2)